@@ -0,0 +1,230 @@
+"""
+Benchmark of the whole pipeline: Streamer -> Ingester -> Processor -> API.
+
+Generates a synthetic dataset, runs every component as a separate process
+against the local Redis and InfluxDB (start them with podman-compose up, the
+database is reset like start.sh does), and reports ingest throughput, the end
+to end latency of each hour (first publish to analytics written), API latency
+percentiles per route and the peak RSS of each component.
+
+Each run works in its own temporary directory, which holds the components'
+logs.csv used to time the hours.
+
+    python3 benchmark.py --stations 2000 --rows-per-hour 4000 --batch-size 500 --hours 4
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import pandas as pd
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+COMPONENTS = ["ingester", "processor", "streamer", "flask_test"]
+STATES = ["AL", "AK", "AZ", "AR", "CA", "CO", "CT", "DE", "DC", "FL", "GA", "HI", "ID", "IL", "IN", "IA", "KS",
+          "KY", "LA", "ME", "MD", "MA", "MI", "MN", "MS", "MO", "MT", "NE", "NV", "NH", "NJ", "NM", "NY", "NC",
+          "ND", "OH", "OK", "OR", "PA", "RI", "SC", "SD", "TN", "TX", "UT", "VT", "VA", "WA", "WV", "WI", "WY"]
+
+
+def generate_dataset(path, stations, rows_per_hour, hours):
+    """Write a CSV shaped like weather_data.csv with rows_per_hour rows for each hour, spread over the stations."""
+    rows = []
+    for hour in range(hours):
+        for row in range(rows_per_hour):
+            station = row % stations
+            rows.append({
+                "time": f"2023-09-19 {hour:02d}:{(row // stations) % 60:02d}",
+                "zip_code": f"{10000 + station:05d}",
+                "state": STATES[station % len(STATES)],
+                "name": f"Station {station}",
+                "temp_c": round(random.uniform(-10, 40), 1),
+                "pressure_mb": round(random.uniform(980, 1040), 1),
+                "humidity": random.randint(0, 100),
+                "precip_mm": round(random.uniform(0, 5), 2),
+            })
+    pd.DataFrame(rows).to_csv(path, index=False)
+
+
+def parse_log(path):
+    """Return (timestamp, message) for every line of a logs.csv file."""
+    entries = []
+    with open(path) as f:
+        for line in f:
+            timestamp, _, message = line.partition(", ")
+            try:
+                entries.append((datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S,%f"), message.strip()))
+            except ValueError:
+                continue
+    return entries
+
+
+def get_hour_timings(entries):
+    """Map each hour to the time its first batch was published and the time its analytics were written."""
+    started = {}
+    finished = {}
+    for timestamp, message in entries:
+        if message.startswith("STREAMER: Starting to publish data for hour "):
+            hour = int(message.rsplit(" ", 1)[1])
+            started.setdefault(hour, timestamp)
+        elif message.startswith("PROCESSOR: Successfully wrote analytics") and message.endswith("weather_averages"):
+            hour = int(message.split("for hour ")[1].split(" ")[0])
+            finished.setdefault(hour, timestamp)
+    return started, finished
+
+
+def get_peak_rss(pid):
+    """Return the peak resident set size of a process in MB, read from /proc."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def measure_api(port, hours, requests, concurrency):
+    """Send random requests to every route and return latency percentiles in milliseconds."""
+    routes = {
+        "/avg": lambda: f"/avg?state={random.choice(STATES)}&hour={random.randrange(hours):02d}",
+        "/extremes": lambda: f"/extremes?state={random.choice(STATES)}&hour={random.randrange(hours):02d}",
+        "/state_extremes": lambda: f"/state_extremes?hour={random.randrange(hours):02d}",
+        "/avg/bulk": lambda: f"/avg/bulk?hour={random.randrange(hours):02d}",
+    }
+
+    def timed_request(path):
+        start = time.perf_counter()
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}{path}", timeout=30).read()
+        except urllib.error.HTTPError:
+            pass # 404s are still answered requests
+        return (time.perf_counter() - start) * 1000
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for route, make_path in routes.items():
+            latencies = list(executor.map(timed_request, [make_path() for _ in range(requests)]))
+            results[route] = {"p50_ms": percentile(latencies, 0.5), "p99_ms": percentile(latencies, 0.99)}
+    return results
+
+
+def wait_for_api(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=1).read()
+            return True
+        except OSError:
+            time.sleep(0.5)
+    return False
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix="weather_benchmark_")
+    data_path = os.path.join(workdir, "weather_data.csv")
+    generate_dataset(data_path, args.stations, args.rows_per_hour, args.hours)
+
+    env = dict(os.environ,
+               STREAMER_DATA=data_path,
+               STREAMER_BATCH_SIZE=str(args.batch_size),
+               STREAMER_HOUR_INTERVAL=str(args.hour_interval),
+               STREAMER_PACING=args.pacing,
+               WEATHER_SHARDS=str(args.shards),
+               API_SERVER="production",
+               API_PORT=str(args.api_port))
+
+    # Reset the database like start.sh
+    subprocess.run([sys.executable, os.path.join(SRC_DIR, "database.py")], cwd=workdir, env=env, check=True,
+                   stdout=subprocess.DEVNULL)
+
+    processes = {}
+    try:
+        for component in COMPONENTS:
+            # One Ingester per shard, each reading its own channels
+            for shard in range(args.shards if component == "ingester" else 1):
+                name = f"{component}_{shard}" if component == "ingester" and args.shards > 1 else component
+                processes[name] = subprocess.Popen([sys.executable, os.path.join(SRC_DIR, f"{component}.py")],
+                                                   cwd=workdir, env=dict(env, INGESTER_SHARD=str(shard)),
+                                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            if component == "processor":
+                time.sleep(1) # Let the Ingester and Processor subscribe before data flows
+
+        # Wait until every hour has its analytics written
+        log_path = os.path.join(workdir, "logs.csv")
+        deadline = time.time() + args.timeout
+        started, finished = {}, {}
+        while time.time() < deadline:
+            if os.path.exists(log_path):
+                started, finished = get_hour_timings(parse_log(log_path))
+                if all(hour in finished for hour in range(args.hours)):
+                    break
+            time.sleep(1)
+
+        api = measure_api(args.api_port, args.hours, args.api_requests, args.api_concurrency) \
+            if wait_for_api(args.api_port) else {}
+        peak_rss = {component: get_peak_rss(process.pid) for component, process in processes.items()}
+    finally:
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            process.wait()
+
+    latencies = [(finished[hour] - started[hour]).total_seconds() for hour in finished if hour in started]
+    report = {
+        "parameters": vars(args),
+        "hours_completed": len(finished),
+        "end_to_end_hour_latency_s": {"p50": percentile(latencies, 0.5), "max": max(latencies, default=None)},
+        "api_latency": api,
+        "peak_rss_mb": peak_rss,
+        "workdir": workdir,
+    }
+    if started and finished:
+        elapsed = (max(finished.values()) - min(started.values())).total_seconds()
+        rows = args.rows_per_hour * len(finished)
+        report["throughput_rows_per_s"] = rows / elapsed if elapsed > 0 else None
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--stations", type=int, default=2000, help="Number of distinct zip codes")
+    parser.add_argument("--rows-per-hour", type=int, default=2000, help="Rows published for each hour")
+    parser.add_argument("--batch-size", type=int, default=500, help="Rows per published batch")
+    parser.add_argument("--hours", type=int, default=4, help="Number of hours in the dataset (at most 24)")
+    parser.add_argument("--hour-interval", type=float, default=5, help="Seconds between the start of two hours")
+    parser.add_argument("--pacing", choices=["interval", "ack"], default="interval",
+                        help="Start hours every interval, or as soon as the previous hour's analytics are written")
+    parser.add_argument("--shards", type=int, default=1, help="Number of ingest shards, each with its own Ingester")
+    parser.add_argument("--api-port", type=int, default=9100)
+    parser.add_argument("--api-requests", type=int, default=200, help="Requests sent to each API route")
+    parser.add_argument("--api-concurrency", type=int, default=8)
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds to wait for every hour to be processed")
+    parser.add_argument("--output", help="Also write the report to this JSON file")
+    args = parser.parse_args()
+    args.hours = min(args.hours, 24)
+
+    report = run(args)
+    print(json.dumps(report, indent=2, default=str))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, default=str)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,22 @@
+import argparse
+import sys
+import threading
+import pandas as pd
 from influxdb import InfluxDBClient
+from influx_writer import InfluxWriter, frame_to_lines
 
-# Initialize InfluxDB client
+# Lines InfluxDB rejected or that could not be written after retries, counted by the writer's workers
+failed_lines = 0
+failed_lock = threading.Lock()
+
+def count_failed(lines):
+    global failed_lines
+    with failed_lock:
+        failed_lines += len(lines)
+
+# Initialize InfluxDB client and writer
 client = InfluxDBClient('localhost', 8086, 'root', 'root', 'myDB')
+writer = InfluxWriter(name="DATABASE", on_error=count_failed, on_rejected=count_failed)
 
 def reset_database(db_name='myDB'):
     """
@@ -17,9 +32,6 @@ def reset_database(db_name='myDB'):
     client.create_database(db_name)
     print(f"Created a new database '{db_name}'.")
 
-# Reset database
-reset_database()
-
 # Columns that are considered tags (static values, indexed for filtering)
 TAG_COLUMNS = ['zip_code', 'state', 'name']
 
@@ -33,47 +45,81 @@ FIELD_COLUMNS = [
     'lat', 'lon'
 ]
 
+# Fields stored as text, other fields are converted to numbers
+STRING_FIELDS = ['wind_dir']
+
+def to_typed_frame(frame):
+    """Convert the field columns of a frame to numbers, values that are not numbers become missing and are skipped."""
+    frame = frame.copy()
+    for field in FIELD_COLUMNS:
+        if field in frame.columns and field not in STRING_FIELDS and not pd.api.types.is_numeric_dtype(frame[field]):
+            frame[field] = pd.to_numeric(frame[field], errors="coerce")
+    return frame
+
+def insert_frame(frame):
+    """
+    Queue the rows of a DataFrame for writing to InfluxDB, converted to line protocol column by column.
+    Lines are submitted in chunks of the writer's batch size, waiting while its queue is full.
+    :return: Number of lines queued
+    """
+    lines = frame_to_lines(to_typed_frame(frame), "weather_data", TAG_COLUMNS, FIELD_COLUMNS)
+    for start in range(0, len(lines), writer.batch_size):
+        writer.submit(lines[start:start + writer.batch_size])
+    return len(lines)
+
 def insert_batch(batch_list):
     """
     Inserts a batch of weather data into InfluxDB in a modular way.
     :param batch_list: List of weather data records (dictionaries)
     :return: None
     """
-    influx_data = []
-
-    for record in batch_list:
-        # Create the tags and fields dynamically
-        tags = {tag: record[tag] for tag in TAG_COLUMNS if tag in record}
-        fields = {}
-
-        for field in FIELD_COLUMNS:
-            # Convert the fields into appropriate types (if needed)
-            if field in record:
-                value = record[field]
-                
-                # Skip any empty or invalid data (could be NaN, None, etc.)
-                if value is not None and value != '':
-                    try:
-                        # Convert values dynamically
-                        if isinstance(value, str) and field != 'wind_dir':  # Allow wind_dir to be a string
-                            value = float(value)  # Convert string numbers to float
-                        fields[field] = value
-                    except ValueError:
-                        # Handle the case where conversion fails (skip the value)
-                        print(f"Skipping invalid value for field: {field}")
-
-        # Add the InfluxDB point for this record
-        influx_point = {
-            "measurement": "weather_data",
-            "tags": tags,
-            "fields": fields,
-            "time": record['time']  # Ensure this is ISO 8601 or epoch time
-        }
-        influx_data.append(influx_point)
-
-    # Write the batch data to InfluxDB
-    client.write_points(influx_data)
-    # print(f"Inserted {len(influx_data)} records into InfluxDB.")
-
-# Run a test function if desired
-# reset_database()  # This ensures a fresh database for each execution
+    insert_frame(pd.DataFrame.from_records(batch_list))
+    writer.flush()
+
+def load_file(path, chunk_size=100000):
+    """
+    Bulk load a CSV or Parquet file of weather data straight into InfluxDB, bypassing Redis.
+    Files are read chunk_size rows at a time so memory stays bounded.
+    :return: Number of records that could not be written
+    """
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq # Only needed for Parquet input
+        batches = pq.ParquetFile(path).iter_batches(batch_size=chunk_size)
+        chunks = (batch.to_pandas() for batch in batches)
+    else:
+        chunks = pd.read_csv(path, chunksize=chunk_size, dtype={column: str for column in TAG_COLUMNS})
+
+    failed_before = failed_lines
+    total = 0
+    for chunk in chunks:
+        total += insert_frame(chunk)
+        print(f"Queued {total} records from '{path}'.")
+    writer.flush()
+
+    failed = failed_lines - failed_before
+    if failed:
+        print(f"Loaded {total - failed} of {total} records from '{path}' into InfluxDB, {failed} could not be written.")
+    else:
+        print(f"Loaded {total} records from '{path}' into InfluxDB.")
+    return failed
+
+def main():
+    parser = argparse.ArgumentParser(description="Reset the weather database or bulk load data into it.")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("reset", help="Drop and recreate the database (default)")
+    load = commands.add_parser("load", help="Bulk load a CSV or Parquet file into the database")
+    load.add_argument("path")
+    load.add_argument("--chunk-size", type=int, default=100000, help="Rows converted and written at a time")
+    load.add_argument("--reset", action="store_true", help="Reset the database before loading")
+    args = parser.parse_args()
+
+    if args.command == "load":
+        if args.reset:
+            reset_database()
+        if load_file(args.path, args.chunk_size):
+            sys.exit(1)
+    else:
+        reset_database()
+
+if __name__ == "__main__":
+    main()
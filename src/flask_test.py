@@ -1,10 +1,259 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, g
 from influxdb import InfluxDBClient
+import csv
+import io
+import json
+import logging
+import os
+import re
+import threading
+from time import sleep
+import time
+import redis
+import messaging
+import metrics
 
-# Initialize InfluxDB client
-client = InfluxDBClient('localhost', 8086, 'root', 'root', 'myDB')
 app = Flask(__name__)
 
+# Serving configuration, "dev" runs the Flask development server, "production" runs waitress
+server_mode = os.environ.get("API_SERVER", "dev")
+port = int(os.environ.get("API_PORT", 9000))
+num_threads = int(os.environ.get("API_THREADS", 8)) # Requests served concurrently by each process
+max_queries = int(os.environ.get("API_MAX_QUERIES", num_threads)) # InfluxDB queries running at once per process
+query_timeout = float(os.environ.get("API_QUERY_TIMEOUT", 10)) # Seconds before an InfluxDB query is abandoned
+
+# One InfluxDB client per process, its connection pool is shared by the request threads
+client = None
+client_pid = None
+client_lock = threading.Lock()
+query_slots = threading.BoundedSemaphore(max_queries)
+
+
+class ServiceBusy(Exception):
+    """Raised when no query slot frees up within the query timeout."""
+
+
+def get_client():
+    """Return this process's InfluxDB client, creating it after a fork."""
+    global client, client_pid
+    with client_lock:
+        if client is None or client_pid != os.getpid():
+            client = InfluxDBClient('localhost', 8086, 'root', 'root', 'myDB', timeout=query_timeout,
+                                    retries=1, pool_size=max_queries)
+            client_pid = os.getpid()
+        return client
+
+def run_query(query):
+    """Run a query within the concurrency limit, returning its points."""
+    if not query_slots.acquire(timeout=query_timeout):
+        raise ServiceBusy("Too many concurrent requests, try again later")
+    try:
+        return list(get_client().query(query).get_points())
+    finally:
+        query_slots.release()
+
+# Analytics never change once written, answers are cached per (route, state) and hour
+# and refreshed when the Processor announces an hour. "memory", "redis" or "off"
+cache_backend = os.environ.get("API_CACHE", "memory")
+r = messaging.get_redis()
+cache = {}  # hour -> {cache key: response}
+cache_lock = threading.Lock()
+
+METRICS = ["temp_c", "pressure_mb", "humidity", "precip_mm"]
+REQUEST_LATENCY = metrics.Histogram("weather_api_request_seconds", "API request latency", ["route", "status"])
+MAX_BULK_KEYS = 5000
+# Values accepted in queries, anything else could change the meaning of the InfluxQL built from them
+STATE_PATTERN = re.compile(r"[A-Za-z .-]+")
+HOUR_PATTERN = re.compile(r"[0-9]{1,2}")
+
+
+def cache_get(hour, key):
+    """Return the cached response for the key at the hour, or None."""
+    if cache_backend == "redis":
+        try:
+            value = r.hget(f"weather_api:cache:{hour}", key)
+            return json.loads(value) if value else None
+        except redis.ConnectionError:
+            return None
+    with cache_lock:
+        return cache.get(hour, {}).get(key)
+
+def cache_set(hour, values):
+    """Store responses for the hour, values maps cache keys to responses."""
+    if cache_backend == "off" or not values:
+        return
+    if cache_backend == "redis":
+        try:
+            r.hset(f"weather_api:cache:{hour}", mapping={key: json.dumps(value) for key, value in values.items()})
+        except redis.ConnectionError:
+            pass
+        return
+    with cache_lock:
+        cache.setdefault(hour, {}).update(values)
+
+def invalidate_hour(hour):
+    if cache_backend == "redis":
+        try:
+            r.delete(f"weather_api:cache:{hour}")
+        except redis.ConnectionError:
+            pass
+        return
+    with cache_lock:
+        cache.pop(hour, None)
+
+def is_valid_state(state):
+    return STATE_PATTERN.fullmatch(state) is not None
+
+def is_valid_hour(hour):
+    return HOUR_PATTERN.fullmatch(hour) is not None and int(hour) <= 23
+
+def quote(value):
+    """Quote a string literal for InfluxQL, escaping backslashes and quotes."""
+    return "'" + str(value).replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+def query_averages(hour, state=None):
+    """Query the averages for the hour, for one state or all of them."""
+    query = f"""
+    SELECT "avg_humidity", "avg_precip_mm", "avg_pressure_mb", "avg_temp_c", "hour", "state"
+    FROM "weather_averages"
+    WHERE "hour" = {quote(hour)}
+    """
+    if state:
+        query += f" AND \"state\" = {quote(state)}"
+    return run_query(query)
+
+def query_zip_extremes(hour, state=None):
+    """Query the zip code extremes for the hour, for one state or all of them."""
+    query = f"""
+    SELECT *
+    FROM "zip_code_extremes"
+    WHERE "hour" = {quote(hour)}
+    """
+    if state:
+        query += f" AND \"state\" = {quote(state)}"
+    return run_query(query)
+
+def build_extremes(data_points):
+    """Find the zip codes with the highest and lowest value of each metric."""
+    extreme_results = {"max": {}, "min": {}}
+    for metric in METRICS:
+        max_metric_key = f"max_{metric}"
+        min_metric_key = f"min_{metric}"
+
+        # Initialize variables for max and min tracking
+        max_value = float('-inf')
+        min_value = float('inf')
+        max_zip_code = None
+        min_zip_code = None
+
+        # Iterate through each record to find max and min values and their corresponding zip codes
+        for record in data_points:
+            if record.get(max_metric_key) is not None and record[max_metric_key] > max_value:
+                max_value = record[max_metric_key]
+                max_zip_code = record["zip_code"]
+
+            if record.get(min_metric_key) is not None and record[min_metric_key] < min_value:
+                min_value = record[min_metric_key]
+                min_zip_code = record["zip_code"]
+
+        # Store the max and min values along with their zip codes
+        if max_value != float('-inf'):
+            extreme_results["max"][metric] = {"zip_code": max_zip_code, "value": max_value}
+        else:
+            extreme_results["max"][metric] = None
+
+        if min_value != float('inf'):
+            extreme_results["min"][metric] = {"zip_code": min_zip_code, "value": min_value}
+        else:
+            extreme_results["min"][metric] = None
+    return extreme_results
+
+def query_state_rankings(hour):
+    """Return the ranking point the Processor stored for the hour, or None."""
+    query = f"""
+    SELECT *
+    FROM "state_rankings"
+    WHERE "hour" = {quote(hour)}
+    """
+    points = run_query(query)
+    return points[0] if points else None
+
+def build_state_extremes(ranking):
+    """Shape a ranking point into the states with the highest and lowest average of each metric."""
+    extreme_results = {"max": {}, "min": {}}
+    for metric in METRICS:
+        for extreme in ("max", "min"):
+            value = ranking.get(f"{extreme}_{metric}")
+            if value is not None:
+                extreme_results[extreme][metric] = {"state": ranking.get(f"{extreme}_{metric}_state"), "value": value}
+            else:
+                extreme_results[extreme][metric] = None
+    return extreme_results
+
+def warm_hour(hour):
+    """Precompute the /avg, /extremes and /state_extremes answers of every state for the hour, one query per measurement."""
+    values = {f"avg:{point['state']}": point for point in query_averages(hour)}
+
+    points_by_state = {}
+    for point in query_zip_extremes(hour):
+        points_by_state.setdefault(point["state"], []).append(point)
+    for state, data_points in points_by_state.items():
+        values[f"extremes:{state}"] = build_extremes(data_points)
+
+    ranking = query_state_rankings(hour)
+    if ranking is not None:
+        values["state_extremes"] = build_state_extremes(ranking)
+
+    invalidate_hour(hour)
+    cache_set(hour, values)
+
+def listen_for_analytics():
+    """Refresh the cache whenever the Processor announces the analytics of an hour."""
+    pubsub = None
+    while True:
+        try:
+            pubsub = messaging.subscribe(r, ["weather_channel:analytics:*"], pubsub)
+            for message in pubsub.listen():
+                if message['type'] == 'pmessage':
+                    hour = str(message['data']).zfill(2)
+                    try:
+                        warm_hour(hour)
+                    except Exception as e:
+                        invalidate_hour(hour)
+                        logging.error(f"API: Failed to warm cache for hour {hour}: {e}")
+        except redis.ConnectionError:
+            sleep(5)
+
+listener_pid = None
+
+@app.before_request
+def start_cache_listener():
+    """Start the cache listener once in each serving process, worker processes start it after forking."""
+    global listener_pid
+    if cache_backend != "off" and listener_pid != os.getpid():
+        with client_lock:
+            if listener_pid != os.getpid():
+                listener_pid = os.getpid()
+                threading.Thread(target=listen_for_analytics, daemon=True).start()
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_latency(response):
+    """Observe the latency of each request under its route pattern, so the label values stay bounded."""
+    started = g.get("request_started")
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        REQUEST_LATENCY.observe(time.perf_counter() - started, route=route, status=response.status_code)
+    return response
+
+@app.route('/metrics')
+def get_metrics():
+    """Metrics of this serving process, each gunicorn worker reports its own."""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
 @app.route('/')
 def respond():
     return 'WeatherVane API is Online!'
@@ -23,23 +272,27 @@ def get_average():
         return jsonify({"error": "State and hour parameters are required"}), 400
 
     # Validate hour format
-    if not hour.isdigit() or int(hour) < 0 or int(hour) > 23:
+    if not is_valid_hour(hour):
         return jsonify({"error": "Invalid hour format. Use 'HH' (e.g., '00', '01')"}), 400
+    hour = hour.zfill(2)
+    if not is_valid_state(state):
+        return jsonify({"error": f"Invalid state '{state}'"}), 400
+
+    cached = cache_get(hour, f"avg:{state}")
+    if cached is not None:
+        return jsonify(cached)
 
     # Query InfluxDB for the averages
-    query = f"""
-    SELECT "avg_humidity", "avg_precip_mm", "avg_pressure_mb", "avg_temp_c", "hour", "state"
-    FROM "weather_averages"
-    WHERE "state" = '{state}' AND "hour" = '{hour}'
-    """
     try:
-        result = client.query(query)
-        points = list(result.get_points())
+        points = query_averages(hour, state)
+    except ServiceBusy as e:
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
     # Return the results or handle no data found
     if points:
+        cache_set(hour, {f"avg:{state}": points[0]})
         return jsonify(points[0])
     else:
         return jsonify({"error": "No data found"}), 404
@@ -56,62 +309,32 @@ def get_location_extremes():
     if not state or not hour:
         return jsonify({"error": "State and hour parameters are required"}), 400
 
-    try:
-        hour = str(hour).zfill(2)  # Ensure hour is always in "HH" format (e.g., "07")
-    except ValueError:
+    if not is_valid_hour(hour):
         return jsonify({"error": "Hour must be a valid integer between 0 and 23"}), 400
+    hour = hour.zfill(2)  # Ensure hour is always in "HH" format (e.g., "07")
+    if not is_valid_state(state):
+        return jsonify({"error": f"Invalid state '{state}'"}), 400
 
-    metrics = ["temp_c", "pressure_mb", "humidity", "precip_mm"]
-    extreme_results = {"max": {}, "min": {}}
+    cached = cache_get(hour, f"extremes:{state}")
+    if cached is not None:
+        return jsonify(cached)
 
     # Step 1: Query InfluxDB to get data for the given state and hour
     try:
-        query = f"""
-        SELECT *
-        FROM "zip_code_extremes"
-        WHERE "state" = '{state}' AND "hour" = '{hour}'
-        """
-        result = client.query(query)
-        data_points = list(result.get_points())
+        data_points = query_zip_extremes(hour, state)
 
         if not data_points:
             return jsonify({"error": f"No data found for state '{state}' and hour '{hour}'"}), 404
 
         # Step 2: Calculate max and min for each metric from the retrieved data
-        for metric in metrics:
-            max_metric_key = f"max_{metric}"
-            min_metric_key = f"min_{metric}"
-
-            # Initialize variables for max and min tracking
-            max_value = float('-inf')
-            min_value = float('inf')
-            max_zip_code = None
-            min_zip_code = None
-
-            # Iterate through each record to find max and min values and their corresponding zip codes
-            for record in data_points:
-                if max_metric_key in record and record[max_metric_key] > max_value:
-                    max_value = record[max_metric_key]
-                    max_zip_code = record["zip_code"]
-
-                if min_metric_key in record and record[min_metric_key] < min_value:
-                    min_value = record[min_metric_key]
-                    min_zip_code = record["zip_code"]
-
-            # Store the max and min values along with their zip codes
-            if max_value != float('-inf'):
-                extreme_results["max"][metric] = {"zip_code": max_zip_code, "value": max_value}
-            else:
-                extreme_results["max"][metric] = None
-
-            if min_value != float('inf'):
-                extreme_results["min"][metric] = {"zip_code": min_zip_code, "value": min_value}
-            else:
-                extreme_results["min"][metric] = None
+        extreme_results = build_extremes(data_points)
+        cache_set(hour, {f"extremes:{state}": extreme_results})
 
         # Step 3: Return the results
         return jsonify(extreme_results)
 
+    except ServiceBusy as e:
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
         print(f"Error occurred: {str(e)}")  # Debugging
         return jsonify({"error": str(e)}), 500
@@ -126,76 +349,176 @@ def get_state_extremes():
     if not hour:
         return jsonify({"error": "Hour parameter is required"}), 400
 
-    try:
-        hour = str(hour).zfill(2)  # Ensure hour is always in "HH" format (e.g., "07")
-    except ValueError:
+    if not is_valid_hour(hour):
         return jsonify({"error": "Hour must be a valid integer between 0 and 23"}), 400
+    hour = hour.zfill(2)  # Ensure hour is always in "HH" format (e.g., "07")
 
-    metrics = ["temp_c", "pressure_mb", "humidity", "precip_mm"]
-    extreme_results = {"max": {}, "min": {}}
+    cached = cache_get(hour, "state_extremes")
+    if cached is not None:
+        return jsonify(cached)
 
-    # Step 1: Query InfluxDB to get data for all states at the given hour
+    # Step 1: Read the state rankings the Processor stored for the hour
     try:
-        query = f"""
-        SELECT *
-        FROM "zip_code_extremes"
-        WHERE "hour" = '{hour}'
-        """
-        result = client.query(query)
-        data_points = list(result.get_points())
-        print(f"Executing query: {query}")  # Debugging
-        result = client.query(query)
-        data_points = list(result.get_points())
-        print(data_points)
+        ranking = query_state_rankings(hour)
 
-        if not data_points:
+        if ranking is None:
             return jsonify({"error": f"No data found for hour '{hour}'"}), 404
 
-        # Step 2: Calculate max and min for each metric from the retrieved data
-        for metric in metrics:
-            avg_metric_key = f"avg_{metric}"
-
-            # Initialize variables for max and min tracking
-            max_value = float('-inf')
-            min_value = float('inf')
-            max_state = None
-            min_state = None
-
-            # Iterate through each record to find max and min values and their corresponding states
-            for record in data_points:
-                state = record["state"]
-
-                if avg_metric_key in record:
-                    value = record[avg_metric_key]
-
-                    # Update max value and corresponding state
-                    if value > max_value:
-                        max_value = value
-                        max_state = state
-
-                    # Update min value and corresponding state
-                    if value < min_value:
-                        min_value = value
-                        min_state = state
-
-            # Store the max and min values along with their states
-            if max_value != float('-inf'):
-                extreme_results["max"][metric] = {"state": max_state, "value": max_value}
-            else:
-                extreme_results["max"][metric] = None
+        # Step 2: Return the results
+        extreme_results = build_state_extremes(ranking)
+        cache_set(hour, {"state_extremes": extreme_results})
+        return jsonify(extreme_results)
 
-            if min_value != float('inf'):
-                extreme_results["min"][metric] = {"state": min_state, "value": min_value}
-            else:
-                extreme_results["min"][metric] = None
+    except ServiceBusy as e:
+        return jsonify({"error": str(e)}), 503
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
-        # Step 3: Return the results
-        return jsonify(extreme_results)
 
+def get_bulk_filter():
+    """
+    Build the WHERE clause of a bulk request from its parameters:
+    hour (every state for the hour), state (every hour for the state), both,
+    or keys, a comma separated list of STATE:HH pairs.
+
+    Returns:
+        tuple: (where clause, error message)
+    """
+    state = request.args.get('state')
+    hour = request.args.get('hour')
+    keys = request.args.get('keys')
+
+    if keys:
+        conditions = []
+        for key in keys.split(",")[:MAX_BULK_KEYS + 1]:
+            key_state, _, key_hour = key.strip().partition(":")
+            if not is_valid_state(key_state) or not is_valid_hour(key_hour):
+                return None, f"Invalid key '{key}', use STATE:HH (e.g., 'CA:07')"
+            conditions.append(f"(\"state\" = {quote(key_state)} AND \"hour\" = {quote(key_hour.zfill(2))})")
+        if len(conditions) > MAX_BULK_KEYS:
+            return None, f"At most {MAX_BULK_KEYS} keys are allowed"
+        return " OR ".join(conditions), None
+
+    conditions = []
+    if hour:
+        if not is_valid_hour(hour):
+            return None, "Invalid hour format. Use 'HH' (e.g., '00', '01')"
+        conditions.append(f"\"hour\" = {quote(hour.zfill(2))}")
+    if state:
+        if not is_valid_state(state):
+            return None, f"Invalid state '{state}'"
+        conditions.append(f"\"state\" = {quote(state)}")
+    if not conditions:
+        return None, "One of the hour, state or keys parameters is required"
+    return " AND ".join(conditions), None
+
+def flatten(record, prefix=""):
+    """Flatten nested dictionaries into one level, joining keys with '_'."""
+    flat = {}
+    for key, value in record.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}_"))
+        else:
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+def bulk_response(records, fieldnames):
+    """Return records as JSON, or streamed as NDJSON or CSV (with the given columns) depending on the format parameter."""
+    response_format = request.args.get('format', 'json')
+
+    if response_format == 'ndjson':
+        def generate():
+            for record in records:
+                yield json.dumps(record) + "\n"
+        return Response(generate(), mimetype="application/x-ndjson")
+
+    if response_format == 'csv':
+        def generate():
+            buffer = io.StringIO()
+            writer = csv.DictWriter(buffer, fieldnames=fieldnames, extrasaction='ignore')
+            writer.writeheader()
+            for record in records:
+                writer.writerow(flatten(record))
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        return Response(generate(), mimetype="text/csv")
+
+    return jsonify(records)
+
+@app.route('/avg/bulk', methods=['GET'])
+def get_average_bulk():
+    """
+    Fetch the averages of many (state, hour) pairs with a single query.
+    See get_bulk_filter for the parameters, format is json (default), ndjson or csv.
+    """
+    where, error = get_bulk_filter()
+    if error:
+        return jsonify({"error": error}), 400
+
+    query = f"""
+    SELECT "avg_humidity", "avg_precip_mm", "avg_pressure_mb", "avg_temp_c", "hour", "state"
+    FROM "weather_averages"
+    WHERE {where}
+    """
+    try:
+        points = run_query(query)
+    except ServiceBusy as e:
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
-        print(f"Error occurred: {str(e)}")  # Debugging
         return jsonify({"error": str(e)}), 500
 
+    for point in points:
+        cache_set(point["hour"], {f"avg:{point['state']}": point})
+    return bulk_response(points, ["state", "hour"] + [f"avg_{metric}" for metric in METRICS])
+
+@app.route('/extremes/bulk', methods=['GET'])
+def get_location_extremes_bulk():
+    """
+    Fetch the zip code extremes of many (state, hour) pairs with a single query.
+    See get_bulk_filter for the parameters, format is json (default), ndjson or csv.
+    """
+    where, error = get_bulk_filter()
+    if error:
+        return jsonify({"error": error}), 400
+
+    query = f"""
+    SELECT *
+    FROM "zip_code_extremes"
+    WHERE {where}
+    """
+    try:
+        points = run_query(query)
+    except ServiceBusy as e:
+        return jsonify({"error": str(e)}), 503
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+    points_by_key = {}
+    for point in points:
+        points_by_key.setdefault((point["state"], point["hour"]), []).append(point)
+
+    records = []
+    for (state, hour), data_points in sorted(points_by_key.items()):
+        extreme_results = build_extremes(data_points)
+        cache_set(hour, {f"extremes:{state}": extreme_results})
+        records.append({"state": state, "hour": hour, **extreme_results})
+    fieldnames = ["state", "hour"] + [
+        f"{extreme}_{metric}_{key}" for extreme in ("max", "min") for metric in METRICS for key in ("zip_code", "value")
+    ]
+    return bulk_response(records, fieldnames)
+
+
+def run_server(use_reloader=True):
+    """Serve the API with the configured server, the development server reloads on changes unless told not to."""
+    if server_mode == "production":
+        from waitress import serve
+        # Threads share the process's InfluxDB connection pool, for more processes run
+        # a multi-worker WSGI server such as "gunicorn -w 4 --threads 8 flask_test:app"
+        serve(app, host='0.0.0.0', port=port, threads=num_threads, channel_timeout=query_timeout * 2)
+    else:
+        app.run(host='0.0.0.0', port=port, debug=True, use_reloader=use_reloader)
+
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=9000, debug=True)
+    run_server()
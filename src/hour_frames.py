@@ -0,0 +1,51 @@
+import glob
+import os
+import pandas as pd
+
+# "influx" reads the hour back from InfluxDB, "local" hands the Ingester's columns to the Processor
+ENGINE = os.environ.get("ANALYTICS_ENGINE", "influx")
+
+frames_dir = "hour_frames"
+
+
+def use_local_engine():
+    """Return True if the Processor computes analytics from frames handed over by the Ingester."""
+    return ENGINE == "local"
+
+def get_frame_path(hour, shard=None):
+    suffix = "" if shard is None else f"_shard{int(shard):02d}"
+    return os.path.join(frames_dir, f"hour_{int(hour):02d}{suffix}.pkl")
+
+def get_frame_paths(hour):
+    """Return the files saved for the hour, one per shard when the ingest path is sharded."""
+    return sorted(glob.glob(get_frame_path(hour)) + glob.glob(os.path.join(frames_dir, f"hour_{int(hour):02d}_shard*.pkl")))
+
+def save_hour_frame(hour, batches, shard=None):
+    """
+    Save the decoded batches of a completed hour, or of its shard, as one columnar frame for the Processor.
+    The file is written under a temporary name and renamed so it is never read half written.
+    """
+    if not batches:
+        return
+    frame = pd.concat([pd.DataFrame(dict(zip(batch["columns"], batch["data"]))) for batch in batches], ignore_index=True)
+    os.makedirs(frames_dir, exist_ok=True)
+    path = get_frame_path(hour, shard)
+    frame.to_pickle(path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+def load_hour_frame(hour):
+    """Return the frame saved for the hour, joining its shards, or None if the Ingesters did not hand it over."""
+    paths = get_frame_paths(hour)
+    if not paths:
+        return None
+    try:
+        return pd.concat([pd.read_pickle(path) for path in paths], ignore_index=True)
+    except FileNotFoundError:
+        return None
+
+def remove_hour_frame(hour):
+    for path in get_frame_paths(hour):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,108 @@
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+import pandas as pd
+
+# Text columns repeated on every row, held as categoricals
+CATEGORY_COLUMNS = ["zip_code", "state", "name"]
+
+
+class HourSpool:
+    """
+    Dataset split into one file per hour of the day.
+
+    The CSV is read in chunks and each chunk's rows are appended to the files
+    of their hours, so memory is bounded by the chunk size however large the
+    dataset is. Only the hours being published are loaded, with categorical
+    zip_code, state and name columns. The spool is kept next to a manifest of
+    the source's size and modification time, so a restart on the same file
+    reuses it instead of reading the CSV again.
+    """
+
+    def __init__(self, source, spool_dir="hour_spool", chunk_size=100000, cached_hours=2):
+        self.source = source
+        self.spool_dir = spool_dir
+        self.chunk_size = chunk_size
+        self.cached_hours = cached_hours
+        self.manifest_path = os.path.join(spool_dir, "manifest.json")
+        self.row_counts = {} # hour -> number of rows
+        self.frames = OrderedDict() # hour -> loaded frame, least recently used first
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+
+    def get_source_stamp(self):
+        stat = os.stat(self.source)
+        return {"source": os.path.abspath(self.source), "size": stat.st_size, "mtime": stat.st_mtime}
+
+    def get_hour_path(self, hour):
+        return os.path.join(self.spool_dir, f"hour_{int(hour):02d}.pkl")
+
+    def build(self):
+        """Split the source into hour files, unless the spool already matches it."""
+        stamp = self.get_source_stamp()
+        try:
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+            # Rebuilt if an hour's file went missing, reading it would fail while the manifest still matches
+            if manifest["stamp"] == stamp and all(os.path.exists(self.get_hour_path(hour)) for hour in manifest["row_counts"]):
+                self.row_counts = {int(hour): count for hour, count in manifest["row_counts"].items()}
+                self.ready.set()
+                return
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+
+        shutil.rmtree(self.spool_dir, ignore_errors=True)
+        parts_dir = os.path.join(self.spool_dir, "parts")
+        os.makedirs(parts_dir)
+
+        row_counts = {}
+        num_parts = {}
+        dtype = {column: "category" for column in CATEGORY_COLUMNS}
+        for chunk in pd.read_csv(self.source, chunksize=self.chunk_size, dtype=dtype):
+            chunk['hour'] = pd.to_datetime(chunk['time']).dt.hour
+            for hour, rows in chunk.groupby('hour', sort=False):
+                hour = int(hour)
+                part = num_parts.get(hour, 0)
+                rows.to_pickle(os.path.join(parts_dir, f"hour_{hour:02d}_{part:05d}.pkl"))
+                num_parts[hour] = part + 1
+                row_counts[hour] = row_counts.get(hour, 0) + len(rows)
+
+        # Merge the parts of each hour, one hour in memory at a time
+        for hour, count in num_parts.items():
+            paths = [os.path.join(parts_dir, f"hour_{hour:02d}_{part:05d}.pkl") for part in range(count)]
+            frame = pd.concat([pd.read_pickle(path) for path in paths], ignore_index=True)
+            for column in CATEGORY_COLUMNS:
+                if column in frame.columns: # Chunks have their own categories, concat falls back to object
+                    frame[column] = frame[column].astype("category")
+            frame.to_pickle(self.get_hour_path(hour))
+        shutil.rmtree(parts_dir)
+
+        with open(self.manifest_path + ".tmp", "w") as f:
+            json.dump({"stamp": stamp, "row_counts": row_counts}, f)
+        os.replace(self.manifest_path + ".tmp", self.manifest_path)
+        self.row_counts = row_counts
+        self.ready.set()
+
+    def get_num_rows(self, hour):
+        self.ready.wait()
+        return self.row_counts.get(hour, 0)
+
+    def get_hour(self, hour):
+        """Return the rows of the hour, loading its file if it is not among the recently used hours."""
+        self.ready.wait()
+        with self.lock:
+            if hour in self.frames:
+                self.frames.move_to_end(hour)
+                return self.frames[hour]
+        if hour not in self.row_counts:
+            return pd.DataFrame()
+
+        frame = pd.read_pickle(self.get_hour_path(hour))
+        with self.lock:
+            self.frames[hour] = frame
+            self.frames.move_to_end(hour)
+            while len(self.frames) > self.cached_hours:
+                self.frames.popitem(last=False)
+        return frame
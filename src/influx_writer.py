@@ -0,0 +1,278 @@
+import logging
+import os
+import queue
+import threading
+import time
+import pandas as pd
+from influxdb import InfluxDBClient
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+from influxdb.line_protocol import make_line
+from requests.exceptions import ConnectionError, Timeout
+import metrics
+
+# Defaults, overridable through the environment
+BATCH_SIZE = int(os.environ.get("INFLUX_WRITE_BATCH_SIZE", 5000)) # Lines per write request
+FLUSH_INTERVAL = float(os.environ.get("INFLUX_FLUSH_INTERVAL", 1.0)) # Seconds before a partial batch is written
+WORKERS = int(os.environ.get("INFLUX_WRITE_WORKERS", 2))
+MAX_QUEUE = int(os.environ.get("INFLUX_WRITE_QUEUE", 1000)) # Submitted chunks waiting to be written
+GZIP = os.environ.get("INFLUX_GZIP", "1") == "1"
+RETRIES = 3
+
+WRITE_LATENCY = metrics.Histogram("weather_influx_write_seconds", "Duration of InfluxDB write requests", ["writer", "result"])
+POINTS_WRITTEN = metrics.Counter("weather_influx_points_written_total", "Points written to InfluxDB", ["writer"])
+QUEUE_DEPTH = metrics.Gauge("weather_influx_write_queue", "Chunks waiting in the InfluxDB write queue", ["writer"])
+
+
+def to_lines(points):
+    """Convert points in the write_points dictionary format to line protocol, lines are kept as they are."""
+    return [
+        point if isinstance(point, str) else
+        make_line(point["measurement"], tags=point.get("tags"), fields=point.get("fields"), time=point.get("time"))
+        for point in points
+    ]
+
+
+def escape_tags(values):
+    """Escape tag values (or keys) for line protocol, like influxdb.line_protocol does."""
+    return (values.astype(str).str.replace("\\", "\\\\", regex=False).str.replace(" ", "\\ ", regex=False)
+            .str.replace(",", "\\,", regex=False).str.replace("=", "\\=", regex=False)
+            .str.replace("\n", "\\n", regex=False))
+
+def format_fields(values):
+    """Format a column of field values for line protocol, integers get the i suffix and text is quoted."""
+    if pd.api.types.is_bool_dtype(values):
+        return values.map({True: "True", False: "False"})
+    if pd.api.types.is_integer_dtype(values):
+        return values.astype(str) + "i"
+    if pd.api.types.is_float_dtype(values):
+        return values.astype(str)
+    escaped = values.astype(str).str.replace("\\", "\\\\", regex=False).str.replace('"', '\\"', regex=False)
+    return '"' + escaped + '"'
+
+def frame_to_lines(frame, measurement, tag_columns=(), field_columns=None, time_column="time"):
+    """
+    Convert a DataFrame to line protocol with column operations instead of a point per row.
+
+    Tags and fields are sorted by key like make_line. Missing (NaN or empty) tags and
+    fields are left out of their row, rows without any field are dropped. Naive times
+    are taken as UTC.
+
+    Returns:
+        list: One line protocol string per row.
+    """
+    if frame.empty:
+        return []
+    if field_columns is None:
+        field_columns = [column for column in frame.columns if column not in tag_columns and column != time_column]
+
+    lines = pd.Series(escape_tags(pd.Series([measurement])).iloc[0], index=frame.index)
+    for tag in sorted(column for column in tag_columns if column in frame.columns):
+        values = frame[tag]
+        present = values.notna() & (values.astype(str) != "")
+        lines = lines.where(~present, lines + f",{tag}=" + escape_tags(values))
+
+    fields = pd.Series("", index=frame.index)
+    for field in sorted(column for column in field_columns if column in frame.columns):
+        values = frame[field]
+        present = values.notna() & (values.astype(str) != "")
+        if not present.any():
+            continue
+        formatted = f"{field}=" + format_fields(values[present])
+        separator = fields[present].where(fields[present] == "", fields[present] + ",")
+        fields[present] = separator + formatted
+
+    has_fields = fields != ""
+    lines = lines[has_fields] + " " + fields[has_fields]
+    if time_column in frame.columns:
+        times = pd.to_datetime(frame.loc[has_fields, time_column])
+        if times.dt.tz is not None:
+            times = times.dt.tz_convert("UTC").dt.tz_localize(None)
+        lines = lines + " " + times.dt.as_unit("ns").astype("int64").astype(str)
+    return lines.tolist()
+
+
+class InfluxWriter:
+    """
+    Writes points to InfluxDB from background workers.
+
+    Callers submit points to a bounded queue and return immediately. Workers
+    convert them to line protocol and write them in batches of up to batch_size
+    lines, or whatever is queued after flush_interval seconds. Each worker owns
+    its own client so writes run in parallel.
+    """
+
+    def __init__(self, database='myDB', host='localhost', port=8086, batch_size=BATCH_SIZE,
+                 flush_interval=FLUSH_INTERVAL, workers=WORKERS, max_queue=MAX_QUEUE, gzip=GZIP,
+                 on_error=None, on_rejected=None, name="WRITER"):
+        self.database = database
+        self.host = host
+        self.port = port
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.num_workers = workers
+        self.gzip = gzip
+        self.on_error = on_error # Called with the lines of a batch that could not be written
+        self.on_rejected = on_rejected # Called with the lines of a batch InfluxDB refused, retrying them is pointless
+        self.name = name
+        self.online = True # False once a write failed after all retries, until a write succeeds
+
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.pending = 0 # Points submitted but not written yet
+        self.pending_condition = threading.Condition()
+        self.flushing = threading.Event()
+        self.stopped = threading.Event()
+        self.workers = []
+        QUEUE_DEPTH.set_function(self.queue.qsize, writer=name)
+
+    def start(self):
+        """Start the background workers."""
+        if self.workers:
+            return self
+        for index in range(self.num_workers):
+            worker = threading.Thread(target=self.run_worker, name=f"influx-writer-{index}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+        return self
+
+    def stop(self, timeout=None):
+        """Write everything still queued, then stop the workers."""
+        self.flush(timeout)
+        self.stopped.set()
+        for worker in self.workers:
+            worker.join(timeout)
+        self.workers = []
+
+    def submit(self, points, on_written=None, timeout=None, on_rejected=None):
+        """
+        Queue points to be written.
+
+        Parameters:
+            points (list): Points in the write_points dictionary format, or line protocol strings.
+            on_written (callable): Called from a worker once all the points are stored.
+            timeout (float): Seconds to wait for space in the queue, None waits forever.
+            on_rejected (callable): Called from a worker if InfluxDB refused the batch holding the points.
+
+        Returns:
+            bool: False if the queue stayed full, the points were not queued.
+        """
+        if not points:
+            if on_written:
+                on_written()
+            return True
+
+        self.start()
+        with self.pending_condition:
+            self.pending += len(points)
+        try:
+            self.queue.put((points, on_written, on_rejected), timeout=timeout)
+        except queue.Full:
+            self.done(len(points))
+            logging.error(f"{self.name}: Write queue full, {len(points)} points not queued")
+            return False
+        return True
+
+    def is_congested(self):
+        """Return True when the queue is mostly full, so producers should slow down."""
+        return self.queue.qsize() >= self.queue.maxsize * 0.8
+
+    def flush(self, timeout=None):
+        """Block until every submitted point has been written, returning False on timeout."""
+        self.flushing.set()
+        try:
+            with self.pending_condition:
+                return self.pending_condition.wait_for(lambda: self.pending == 0, timeout)
+        finally:
+            self.flushing.clear()
+
+    def ping(self):
+        """Check whether InfluxDB is reachable again after a failed write."""
+        try:
+            InfluxDBClient(self.host, self.port, 'root', 'root', self.database, timeout=5).ping()
+            self.online = True
+        except (ConnectionError, Timeout, InfluxDBServerError):
+            self.online = False
+        return self.online
+
+    def done(self, count):
+        with self.pending_condition:
+            self.pending -= count
+            if self.pending == 0:
+                self.pending_condition.notify_all()
+
+    def next_batch(self):
+        """Collect queued chunks until the batch is full, the flush interval passes or a flush is requested."""
+        chunks = []
+        size = 0
+        deadline = time.monotonic() + self.flush_interval
+        while size < self.batch_size:
+            try:
+                chunk = self.queue.get_nowait()
+            except queue.Empty:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self.stopped.is_set() or (chunks and self.flushing.is_set()):
+                    break
+                try:
+                    chunk = self.queue.get(timeout=min(remaining, 0.05))
+                except queue.Empty:
+                    continue
+            chunks.append(chunk)
+            size += len(chunk[0])
+        return chunks
+
+    def run_worker(self):
+        client = InfluxDBClient(self.host, self.port, 'root', 'root', self.database, gzip=self.gzip)
+        while not (self.stopped.is_set() and self.queue.empty()):
+            chunks = self.next_batch()
+            if not chunks:
+                continue
+
+            lines = []
+            written = []
+            rejected = []
+            for points, on_written, on_rejected in chunks:
+                try:
+                    lines.extend(to_lines(points))
+                    written.append((on_written, on_rejected))
+                except (ValueError, TypeError, KeyError) as e:
+                    logging.error(f"{self.name}: Skipping {len(points)} invalid points: {e}")
+                    rejected.append(on_rejected)
+
+            result = self.write(client, lines) if lines else None
+            if result == "ok":
+                callbacks = [on_written for on_written, _ in written]
+            else: # Lines that failed are handed to on_error, rejected ones can only be reported
+                callbacks = [on_rejected for _, on_rejected in written] if result == "rejected" else []
+            for callback in callbacks + rejected:
+                try:
+                    if callback:
+                        callback()
+                except Exception as e:
+                    logging.error(f"{self.name}: Write callback failed: {e}")
+            self.done(sum(len(chunk[0]) for chunk in chunks))
+
+    def write(self, client, lines):
+        """Write lines, retrying connection and server errors with backoff. Returns "ok", "rejected" or "failed"."""
+        for attempt in range(RETRIES):
+            started = time.perf_counter()
+            try:
+                client.write_points(lines, protocol='line')
+                WRITE_LATENCY.observe(time.perf_counter() - started, writer=self.name, result="ok")
+                POINTS_WRITTEN.inc(len(lines), writer=self.name)
+                self.online = True
+                return "ok"
+            except InfluxDBClientError as e:
+                # Rejected data will be rejected again, do not retry
+                WRITE_LATENCY.observe(time.perf_counter() - started, writer=self.name, result="rejected")
+                logging.error(f"{self.name}: InfluxDB rejected {len(lines)} points: {e}")
+                if self.on_rejected:
+                    self.on_rejected(lines)
+                return "rejected"
+            except (ConnectionError, Timeout, InfluxDBServerError) as e:
+                WRITE_LATENCY.observe(time.perf_counter() - started, writer=self.name, result="failed")
+                logging.error(f"{self.name}: InfluxDB write failed (attempt {attempt + 1}): {e}")
+                self.stopped.wait(2 ** attempt)
+
+        self.online = False
+        if self.on_error:
+            self.on_error(lines)
+        return "failed"
@@ -1,97 +1,39 @@
 import redis
-import json
 import logging
+import time
 from time import sleep
-from influxdb import InfluxDBClient
 import os
-import queue
+import fcntl
+import itertools
 import threading
+from functools import partial
 from influxdb.exceptions import InfluxDBClientError
-from requests.exceptions import ConnectionError
+import wire
+import messaging
+import sharding
+import metrics
+from influx_writer import InfluxWriter
+from spill_queue import SpillQueue
+import hour_frames
+
+# Defaults, overridable through the environment
+WIRE_FORMAT = os.environ.get("WIRE_FORMAT", "columnar+zlib") # Batch format advertised to the Streamer
+WRITE_MODE = os.environ.get("INGESTER_WRITE_MODE", "hour") # "hour" writes complete hours, "incremental" writes batches on arrival
+REPLAY_TIMEOUT = float(os.environ.get("INGESTER_REPLAY_TIMEOUT", 5)) # Seconds before batches still missing are requested again
+WRITE_TIMEOUT = float(os.environ.get("INGESTER_WRITE_TIMEOUT", 30)) # Seconds a complete hour waits for its writes before they are sent again
+LATE_BATCH_WINDOW = 60 # Seconds during which batches of an hour already announced are ignored as duplicates
+SHARD = int(os.environ.get("INGESTER_SHARD", 0)) # Shard consumed when the ingest path is split into WEATHER_SHARDS
+NUM_BATCHES_PER_HOUR = 88 # Default number of batches per hour, when the LAST batch does not announce it
+BACKUP_DIR = "backup_data"
+METRICS_PORT = int(os.environ.get("INGESTER_METRICS_PORT", 9110)) # Shard N serves on this port + N, 0 disables it
+
+BATCHES_RECEIVED = metrics.Counter("weather_batches_received_total", "Batches received from the Streamer, including duplicates")
+BATCHES_REQUESTED = metrics.Counter("weather_batches_requested_total", "Missing batches requested from the Streamer again")
+BATCHES_WRITTEN = metrics.Counter("weather_batches_written_total", "Batches stored in InfluxDB")
+HOURS_COMPLETED = metrics.Counter("weather_hours_completed_total", "Hours, or hours of a shard, with every batch stored")
+CACHED_BATCHES = metrics.Gauge("weather_ingester_cached_batches", "Batches held until their hour is complete")
+PENDING_DEPTH = metrics.Gauge("weather_ingester_pending", "Items queued while Redis or InfluxDB is down", ["queue"])
 
-# Initialize logging
-logging.basicConfig(filename="logs.csv", level=logging.INFO, format="%(asctime)s, %(message)s")
-
-# Initialize Redis and InfluxDB clients
-r = redis.Redis(host='127.0.0.1', port=6379, decode_responses=True)
-client = InfluxDBClient('localhost', 8086, 'root', 'root', 'myDB')
-pending_messages = queue.Queue()  # Queue to store messages when Redis is down
-
-cached_data = queue.Queue()  # Queue to store data
-received_batches_indexes = {}  # Store received batch indexes for each hour
-num_batches_per_hour = 88 # Number of batches per hour
-
-influx_online = True
-
-def handle_message(message):
-    """Process each message received from Redis."""
-    try:
-        batch_data = json.loads(message['data'])
-        send_raw_data_to_influxdb(batch_data)
-        
-
-    except redis.ConnectionError as e: # is this needed
-        logging.error(f"INGESTER: Redis down, unable to process message: {e}")
-
-    except json.JSONDecodeError as e:
-        logging.error(f"INGESTER: Invalid JSON data, unable to process message: {e}")
-
-
-def send_raw_data_to_influxdb(batch_data):
-    global influx_online
-
-    """Save raw weather data to the 'weather_data' measurement in InfluxDB."""
-    points = []
-    for entry in batch_data:
-        points.append({
-            "measurement": "weather_data",
-            "tags": {
-                "zip_code": entry["zip_code"],
-                "state": entry["state"]
-            },
-            "fields": {
-                "temp_c": entry["temp_c"],
-                "pressure_mb": entry["pressure_mb"],
-                "humidity": entry["humidity"],
-                "precip_mm": entry["precip_mm"]
-            },
-            "time": entry["time"]
-        })
-
-    try:
-        client.write_points(points)
-    
-    except ConnectionError as e:
-        logging.error(f"INGESTER: Connection error, queuing data: {e}")
-        influx_online = False
-        sleep(5) # Wait for Redis to come back online
-    
-    influx_online = True
-
-def notify_processor(hour):
-    """Notify Processor to begin analytics for a completed hour."""
-    try:
-        r.publish(f"weather_channel:processor:{hour}", hour)
-        logging.info(f"INGESTER: Notified Processor to start analytics for hour {hour}")
-    except redis.ConnectionError:
-        logging.error(f"INGESTER: Failed to notify Processor for hour {hour}")
-        pending_messages.put(f"weather_channel:processor:{hour}", hour)
-
-def send_pending():
-    # send any data that is cached
-    global cached_data
-    for message in list(cached_data.queue):
-        handle_message(message)
-    for message in list(pending_messages.queue):
-        print("pending messages")
-        pending_messages.queue.remove(message)
-
-    
-
-def pending_data_thread_handler():
-    while True:
-        send_pending()
-        sleep(15)
 
 def get_parts(channel) :
     parts = channel.split(":")
@@ -101,127 +43,568 @@ def get_parts(channel) :
     hour = parts[3]
     return channel_name, type_message, batch_index, hour
 
-def clear_cached_data_for_hour(hour):
-    """Remove cached messages for a specific hour after all batches are received."""
-    global cached_data
-    cached_data.queue = [msg for msg in cached_data.queue if get_parts(msg['channel'])[3] != hour]
-
-def all_batches_received(hour):
-    """Check if all batches for the hour have been received."""
-
-    global received_batches_indexes
-    global cached_data
-
-    cached_data_list = list(cached_data.queue)
-
-    for cached_data_item in cached_data_list:
-
-        message = cached_data_item
-        channel = message['channel']
-        channel_name, type_message, batch_index, message_hour = get_parts(channel)
-        if hour not in received_batches_indexes:
-                received_batches_indexes[hour] = set()
-        # Check if the message is for the same hour
-        if message_hour == hour:
-            # Check if all batches are present for the hour
-            if batch_index == "LAST":
-                received_batches_indexes[hour].add(num_batches_per_hour-1)
-            else:
-                received_batches_indexes[hour].add(int(batch_index))
-    
-    for index in range(num_batches_per_hour):
-        if index not in received_batches_indexes[hour]:    
-            return False
-    
-    return True
-    
-
-def request_batches(hour):
-    """Request any missing batches for the hour."""
-
-    global received_batches_indexes
-    global cached_data
-
-    missing_batches = set()
-    for index in range(num_batches_per_hour-1):
-        if index not in received_batches_indexes[hour]:
-            missing_batches.add(index)
+def get_num_batches(message, default=NUM_BATCHES_PER_HOUR):
+    """Return the number of batches in the hour announced by the message, or the default if it has none."""
     try:
-        # iterate through all missing batches and request them
-        for batch_index in missing_batches:
-            r.publish(f"weather_channel:request:{batch_index}:{hour}", hour)
-            logging.info(f"INGESTER: Requested missing batch {batch_index} for hour {hour}")
-            sleep(0.1)
-            return batch_index
-
-    except redis.ConnectionError:
-        logging.error(f"INGESTER: Failed to request missing batches for hour {hour}")
-        sleep(10)
-
-def send_all_cached_data(hour):
-    """Send all cached data for the hour to InfluxDB."""
-    global cached_data
-    logging.info(f"INGESTER: Sending all cached data for hour {hour}")
-    for message in list(cached_data.queue):
-        if get_parts(message['channel'])[3] == hour:
-            handle_message(message)
-
-def handle_incoming_messages():
-    global cached_data
-    
-    while True:
-
+        return wire.get_num_batches(message['data']) or default
+    except wire.WireFormatError:
+        return default
+
+
+class HourBuffer:
+    """Reassembly buffer holding the batches of one hour, keyed by batch index."""
+
+    def __init__(self, keep_batches=False, replay_timeout=REPLAY_TIMEOUT):
+        self.messages = {}  # batch index -> message
+        self.received = 0  # Bitmap of received batch indexes
+        self.num_received = 0
+        self.num_batches = None  # Announced in the header of every batch, or learned from the LAST marker
+        self.received_last = False
+        self.replay_timeout = replay_timeout
+        self.request_deadline = 0  # Time after which missing batches are requested (again)
+        self.write_deadline = None  # Set once every batch arrived, time after which batches not written are sent again
+        self.batches = {} if keep_batches else None  # batch index -> decoded batch handed to the Processor
+
+    def add(self, batch_index, message):
+        """
+        Store a batch, returning its index or None if it was already received.
+        Missing batches become due once the LAST batch arrives, or once no new batch arrived for
+        the replay timeout, so an hour whose LAST batch was lost is requested too.
+        """
+        if batch_index == "LAST":
+            self.num_batches = get_num_batches(message)
+            index = self.num_batches - 1
+        else:
+            index = int(batch_index)
+            if self.num_batches is None:
+                self.num_batches = get_num_batches(message, None)
+
+        if self.received >> index & 1:
+            return None
+
+        if batch_index == "LAST":
+            self.received_last = True
+            self.request_deadline = 0
+        elif not self.received_last:
+            self.request_deadline = time.monotonic() + self.replay_timeout
+        self.received |= 1 << index
+        self.num_received += 1
+        self.messages[index] = message
+        return index
+
+    def release(self, index):
+        """Drop a stored batch once it has been written, keeping it counted as received."""
+        self.messages.pop(index, None)
+
+    def is_complete(self):
+        return self.num_batches is not None and self.num_received >= self.num_batches
+
+    def missing_batches(self):
+        """Return the indexes of the batches not received yet."""
+        num_batches = self.num_batches or NUM_BATCHES_PER_HOUR
+        return [index for index in range(num_batches) if not self.received >> index & 1]
+
+
+class Ingester:
+    """
+    Reassembles the Streamer's batches, writes them to InfluxDB and notifies the Processor of completed hours.
+
+    Nothing is connected or opened until start(): the Redis client is created on
+    first use unless one is passed in, and the InfluxDB writer starts its workers
+    on the first write. With a data_ring batches come from a co-located Streamer
+    through shared memory, and with a notify_ring completed hours are announced to
+    a co-located Processor the same way, and also on Redis when mirror_redis is set.
+
+    With num_shards above 1 each instance consumes the channels of its own shard,
+    and records the shard's completed hours in a Redis set. The instance that
+    completes the last shard of an hour is the one that notifies the Processor.
+    """
+
+    def __init__(self, wire_format=WIRE_FORMAT, write_mode=WRITE_MODE, replay_timeout=REPLAY_TIMEOUT,
+                 write_timeout=WRITE_TIMEOUT, transport=None, local_engine=None, backup_dir=BACKUP_DIR, redis_client=None, writer=None,
+                 data_ring=None, notify_ring=None, mirror_redis=False, num_shards=sharding.NUM_SHARDS, shard=SHARD):
+        self.wire_format = wire_format
+        self.write_mode = write_mode
+        self.replay_timeout = replay_timeout
+        self.write_timeout = write_timeout
+        self.streams = messaging.use_streams() if transport is None else transport == "streams"
+        self.local_engine = hour_frames.use_local_engine() if local_engine is None else local_engine
+        self.backup_dir = backup_dir
+        self.client = redis_client
+        self.writer = writer or InfluxWriter(name="INGESTER", on_error=self.on_write_error)
+        self.data_ring = data_ring
+        self.notify_ring = notify_ring
+        self.mirror_redis = mirror_redis
+        self.num_shards = num_shards
+        self.shard = shard if num_shards > 1 else None
+
+        self.hour_buffers = {}  # Reassembly buffer of received batches for each hour, kept until the hour is written
+        self.hours_lock = threading.Lock()  # Taken to remove a written hour, from the writer's workers
+        self.completed_hours = {}  # hour -> time it was announced, to ignore late duplicates
+        self.pending_messages = None  # Messages not sent while Redis is down, opened by start()
+        self.pending_writes = None  # Points not written while InfluxDB is down, opened by start()
+        self.influx_online = True
+        self.backup_lock = None  # Held while this instance owns its outage queue files
+        self.backup_prefix = None  # Name of those files, unique on the host while the lock is held
+        self.stopped = threading.Event()
+        self.threads = []
+
+    @property
+    def r(self):
+        if self.client is None:
+            self.client = messaging.get_redis()
+        return self.client
+
+    def start(self):
+        """Open the outage queues and start consuming batches."""
+        if self.threads:
+            return self
+        self.stopped.clear()
+        self.backup_prefix = self.claim_backup_prefix()
+        self.pending_messages = SpillQueue(os.path.join(self.backup_dir, f"{self.backup_prefix}_messages.log"))
+        self.pending_writes = SpillQueue(os.path.join(self.backup_dir, f"{self.backup_prefix}_writes.log"))
+        CACHED_BATCHES.set_function(self.count_cached_batches)
+        PENDING_DEPTH.set_function(self.pending_messages.qsize, queue="messages")
+        PENDING_DEPTH.set_function(self.pending_writes.qsize, queue="writes")
+        if self.data_ring is not None:
+            handler = self.handle_ring_messages
+        else:
+            handler = self.handle_stream_messages if self.streams else self.handle_incoming_messages
+        for target in [handler, self.pending_data_thread_handler]:
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def stop(self, timeout=5):
+        """Stop consuming, write what is queued and move the outage queues to disk."""
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+        self.writer.stop(timeout)
+        for pending in [self.pending_messages, self.pending_writes]:
+            if pending is not None:
+                pending.close()
+        if self.backup_lock is not None:
+            self.backup_lock.close()
+            self.backup_lock = None
+        logging.info("INGESTER: Shutting down.")
+
+    def claim_backup_prefix(self):
+        """
+        Return the prefix of this instance's outage queue files, locked so Ingesters sharing a directory,
+        one per shard or several in streams mode, never share a queue. The Ingester of shard N uses
+        ingester_shardN, further instances add a number, and a restarted instance reclaims the same files.
+        """
+        base = "ingester" if self.shard is None else f"ingester_shard{self.shard}"
+        os.makedirs(self.backup_dir, exist_ok=True)
+        for number in itertools.count():
+            prefix = base if number == 0 else f"{base}_{number}"
+            lock = open(os.path.join(self.backup_dir, f"{prefix}.lock"), "w")
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB) # Released by the kernel if the process dies
+            except OSError:
+                lock.close()
+                continue
+            self.backup_lock = lock
+            return prefix
+
+    def on_write_error(self, lines):
+        """Called by the writer when InfluxDB stays unreachable after retries."""
+        logging.error(f"INGESTER: InfluxDB unavailable, queuing {len(lines)} points")
+        self.influx_online = False
+        self.pending_writes.put(lines)
+
+    def count_cached_batches(self):
+        return sum(len(buffer.messages) for buffer in list(self.hour_buffers.values()))
+
+    def on_batch_written(self, on_written=None):
+        BATCHES_WRITTEN.inc()
+        if on_written:
+            on_written()
+
+    def handle_message(self, message, on_written=None, batches=None, index=None, on_rejected=None):
+        """
+        Process each message received from Redis, returning True once its points are queued for writing.
+        The decoded batch is stored in batches under its index when given, unless it already is.
+        """
         try:
-            pubsub = r.pubsub()
-            pubsub.psubscribe("weather_channel:data:*")
-            logging.info("INGESTER: Subscribed to Streamer data channels.")
-            received_last = False
-            last_request_index = -1
-
-            for message in pubsub.listen():
-
-                if message['type'] == 'pmessage':
-                    
-                    channel = message['channel']
-                    channel_name, type_message, batch_index, hour = get_parts(channel)
-
-                    if channel.startswith("weather_channel:data:"):
-                        if batch_index == "LAST": # last batch, make sure all other batches have been received
-                            received_last = True
-                        
-                        cached_data.put(message)
-            
-                        if all_batches_received(hour):
-                            send_all_cached_data(hour)
-                            notify_processor(hour)
-                            clear_cached_data_for_hour(hour)
-                            # logging.info(f"INGESTER: Completed receiving data for hour {hour}")
-                            received_last = False
-                        elif received_last:
-                            if last_request_index == request_batches(hour):
-                                logging.info(f"INGESTER: Requested the same batch {last_request_index} for hour {hour}")
-                                sleep(15)
-                            
-
+            batch = wire.decode_batch(message['data'])
+            if batches is not None:
+                batches.setdefault(index, batch) # A resent batch was kept when it first arrived
+            return self.send_raw_data_to_influxdb(wire.iter_records(batch), partial(self.on_batch_written, on_written),
+                                                  on_rejected)
+
+        except redis.ConnectionError as e: # is this needed
+            logging.error(f"INGESTER: Redis down, unable to process message: {e}")
+
+        except ValueError as e: # Covers json.JSONDecodeError and wire.WireFormatError
+            logging.error(f"INGESTER: Invalid batch data, unable to process message: {e}")
+
+        return False
+
+    def send_raw_data_to_influxdb(self, batch_data, on_written=None, on_rejected=None):
+        """
+        Queue raw weather data for the 'weather_data' measurement in InfluxDB.
+        on_written is called once the points are stored, on_rejected if InfluxDB refuses them.
+        """
+        points = []
+        for entry in batch_data:
+            points.append({
+                "measurement": "weather_data",
+                "tags": {
+                    "zip_code": entry["zip_code"],
+                    "state": entry["state"]
+                },
+                "fields": {
+                    "temp_c": entry["temp_c"],
+                    "pressure_mb": entry["pressure_mb"],
+                    "humidity": entry["humidity"],
+                    "precip_mm": entry["precip_mm"]
+                },
+                "time": entry["time"]
+            })
+
+        return self.writer.submit(points, on_written, on_rejected=on_rejected)
+
+    def wait_for_writer(self):
+        """Hold off consuming new batches while the InfluxDB writer is congested."""
+        if self.writer.is_congested():
+            logging.info("INGESTER: InfluxDB writer congested, pausing consumption")
+            while self.writer.is_congested() and not self.stopped.is_set():
+                sleep(0.1)
+
+    def notify_processor(self, hour):
+        """Notify Processor to begin analytics for a completed hour."""
+        if self.notify_ring is not None:
+            self.notify_ring.put((f"weather_channel:processor:{hour}", hour))
+            logging.info(f"INGESTER: Notified co-located Processor to start analytics for hour {hour}")
+            if not self.mirror_redis:
+                return
+        try:
+            messaging.publish(self.r, f"weather_channel:processor:{hour}", hour)
+            logging.info(f"INGESTER: Notified Processor to start analytics for hour {hour}")
+        except redis.ConnectionError:
+            logging.error(f"INGESTER: Failed to notify Processor for hour {hour}")
+            self.pending_messages.put((f"weather_channel:processor:{hour}", hour))
+
+    def add_completed_shard(self, hour, shard):
+        """
+        Record the shard as complete for the hour, notifying the Processor if it was the last one.
+        Only one instance can delete the completed set, so the hour is announced once.
+        """
+        key = f"weather_ingest:shards:{hour}"
+        pipe = self.r.pipeline()
+        pipe.sadd(key, shard)
+        pipe.expire(key, 86400)
+        pipe.scard(key)
+        completed = pipe.execute()[-1]
+        logging.info(f"INGESTER: Completed shard {shard} of hour {hour}, {completed} of {self.num_shards} shards done")
+
+        if completed >= self.num_shards and self.r.delete(key):
+            self.notify_processor(hour)
+
+    def complete_hour(self, hour, shard=None):
+        """Notify the Processor of a completed hour, once every shard of it is complete when sharded."""
+        HOURS_COMPLETED.inc()
+        if shard is None:
+            self.notify_processor(hour)
+            return
+        try:
+            self.add_completed_shard(hour, shard)
+        except redis.ConnectionError:
+            logging.error(f"INGESTER: Failed to record shard {shard} of hour {hour} as complete")
+            self.pending_messages.put((f"weather_ingest:shards:{hour}", shard))
+
+    def send_pending_message(self, item):
+        channel, message = item
+        if channel.startswith("weather_ingest:shards:"): # Completed shard not recorded while Redis was down
+            self.add_completed_shard(channel.rsplit(":", 1)[1], message)
+        else:
+            messaging.publish(self.r, channel, message)
+
+    def send_pending(self):
+        """Replay notifications and points queued while Redis or InfluxDB was down."""
+        try:
+            sent = self.pending_messages.drain(self.send_pending_message)
+            if sent:
+                logging.info(f"INGESTER: Sent {sent} pending messages to Redis.")
+        except redis.ConnectionError:
+            logging.error(f"INGESTER: Redis still down, keeping {self.pending_messages.qsize()} pending messages")
+
+        if not self.pending_writes.empty() and (self.writer.online or self.writer.ping()):
+            self.influx_online = True
+            sent = self.pending_writes.drain(self.writer.submit)
+            logging.info(f"INGESTER: Resent {sent} pending batches to InfluxDB.")
+
+    def pending_data_thread_handler(self):
+        while not self.stopped.is_set():
+            self.send_pending()
+            self.send_overdue_hours()
+            self.stopped.wait(15)
+
+    def get_hour_buffer(self, hour):
+        """Return the reassembly buffer for the hour, creating it on the first batch."""
+        if hour not in self.hour_buffers:
+            self.hour_buffers[hour] = HourBuffer(keep_batches=self.local_engine, replay_timeout=self.replay_timeout)
+        return self.hour_buffers[hour]
+
+    def clear_cached_data_for_hour(self, hour):
+        """Remove cached messages for a specific hour after all batches are written."""
+        self.hour_buffers.pop(hour, None)
+        self.completed_hours[hour] = time.monotonic()
+
+    def is_late_batch(self, hour):
+        """Return True if the hour was announced moments ago, its batch is a replay that arrived late."""
+        completed = self.completed_hours.get(hour)
+        if completed is None:
+            return False
+        if time.monotonic() - completed < LATE_BATCH_WINDOW:
+            return True
+        self.completed_hours.pop(hour, None)
+        return False
+
+    def all_batches_received(self, hour):
+        """Check if all batches for the hour have been received."""
+        return hour in self.hour_buffers and self.hour_buffers[hour].is_complete()
+
+    def request_batches(self, hour):
+        """
+        Request all missing batches for the hour in a single message listing their index ranges.
+        They are requested again if some are still missing once the replay timeout has passed.
+        """
+        buffer = self.get_hour_buffer(hour)
+        missing_batches = buffer.missing_batches()
+        buffer.request_deadline = time.monotonic() + self.replay_timeout
+        try:
+            ranges = wire.format_ranges(missing_batches)
+            self.r.publish(f"weather_channel:request:BATCHES:{hour}{sharding.get_channel_suffix(self.shard)}", ranges)
+            BATCHES_REQUESTED.inc(len(missing_batches))
+            logging.info(f"INGESTER: Requested {len(missing_batches)} missing batches {ranges} for hour {hour}")
 
         except redis.ConnectionError:
-            logging.error("INGESTER: Redis connection lost. Attempting to reconnect...")
-            sleep(5)
-        except InfluxDBClientError:
-            logging.error("INGESTER: InfluxDB connection lost. Attempting to reconnect...")
-            sleep(5)
-
-# Start the data publishing thread
-channel_handler = threading.Thread(target=handle_incoming_messages, daemon=True)
-channel_handler.start()
-
-pending_data_thread = threading.Thread(target=pending_data_thread_handler, daemon=True)
-pending_data_thread.start()
-
-# Keep the main thread alive to maintain the background threads
-try:
-    while True:
-        sleep(1)
-except KeyboardInterrupt:
-    logging.info("STREAMER: Shutting down.")
-    print("Shutting down...")
+            logging.error(f"INGESTER: Failed to request missing batches for hour {hour}")
+
+    def request_overdue_batches(self):
+        """Request the missing batches, the LAST one included, of every incomplete hour whose replay deadline passed."""
+        now = time.monotonic()
+        for hour, buffer in list(self.hour_buffers.items()):
+            if not buffer.is_complete() and now >= buffer.request_deadline:
+                self.request_batches(hour)
+
+    def send_hour_batches(self, hour, buffer):
+        """Submit every batch of the hour not written yet, each releasing itself once written."""
+        for index, message in list(buffer.messages.items()):
+            if not self.handle_message(message, partial(self.on_hour_batch_written, hour, index), buffer.batches, index):
+                self.on_hour_batch_written(hour, index) # Invalid, resending it would not help
+
+    def send_all_cached_data(self, hour):
+        """
+        Send the cached data of a complete hour to InfluxDB without waiting for it, in incremental mode
+        only batches whose write failed remain. The write callback of its last batch announces the hour,
+        so an hour whose points were queued while InfluxDB is down is not announced until they are
+        written. Batches still not written after the write timeout are sent again by send_overdue_hours.
+        """
+        logging.info(f"INGESTER: Sending all cached data for hour {hour}")
+        buffer = self.get_hour_buffer(hour)
+        if self.write_mode != "incremental": # Otherwise submitted on arrival
+            self.send_hour_batches(hour, buffer)
+
+        if buffer.batches is not None:
+            hour_frames.save_hour_frame(hour, [buffer.batches[index] for index in sorted(buffer.batches)], self.shard)
+        # Set last so the hour is not announced before its frame is saved
+        buffer.write_deadline = time.monotonic() + self.write_timeout
+        self.on_hour_batch_written(hour, None) # Every batch may be written already
+
+    def on_hour_batch_written(self, hour, index):
+        """Release a written batch, announcing its hour once every batch of it is written."""
+        with self.hours_lock:
+            buffer = self.hour_buffers.get(hour)
+            if buffer is None:
+                return
+            buffer.release(index)
+            if buffer.write_deadline is None or buffer.messages:
+                return
+            self.clear_cached_data_for_hour(hour)
+        self.complete_hour(hour, self.shard)
+
+    def send_overdue_hours(self):
+        """Send again the batches of complete hours not written within the write timeout, once InfluxDB is reachable."""
+        now = time.monotonic()
+        for hour, buffer in list(self.hour_buffers.items()):
+            if buffer.write_deadline is None or now < buffer.write_deadline or not buffer.messages:
+                continue
+            if not (self.writer.online or self.writer.ping()):
+                logging.error(f"INGESTER: InfluxDB still down, hour {hour} stays pending with {len(buffer.messages)} batches not written")
+                return
+            logging.info(f"INGESTER: Sending {len(buffer.messages)} batches of hour {hour} not written yet again")
+            buffer.write_deadline = time.monotonic() + self.write_timeout
+            self.send_hour_batches(hour, buffer)
+
+    def advertise_wire_format(self):
+        """Tell the Streamer which batch format this Ingester wants to receive."""
+        if self.wire_format in wire.FORMATS:
+            self.r.set(wire.FORMAT_KEY, self.wire_format)
+
+    def handle_data_message(self, message):
+        """Add a batch to its hour's buffer, writing and announcing the hour once it is complete."""
+        channel = message['channel']
+        channel_name, type_message, batch_index, hour = get_parts(channel)
+
+        if channel.startswith("weather_channel:data:"):
+            BATCHES_RECEIVED.inc()
+            if self.is_late_batch(hour):
+                return
+            buffer = self.get_hour_buffer(hour)
+            index = buffer.add(batch_index, message)
+
+            # Points are keyed by time and tags, so writing early is idempotent
+            if self.write_mode == "incremental" and index is not None:
+                self.handle_message(message, partial(self.on_hour_batch_written, hour, index), buffer.batches, index)
+
+            if index is not None and buffer.is_complete():
+                self.send_all_cached_data(hour)
+                # logging.info(f"INGESTER: Completed receiving data for hour {hour}")
+
+            self.wait_for_writer()
+
+    def handle_incoming_messages(self):
+
+        pubsub = None
+        while not self.stopped.is_set():
+
+            try:
+                self.advertise_wire_format()
+                suffix = sharding.get_channel_suffix(self.shard)
+                pubsub = messaging.subscribe(self.r, [f"weather_channel:data:*{suffix}"], pubsub)
+                logging.info(f"INGESTER: Subscribed to Streamer data channels{f' of shard {self.shard}' if suffix else ''}.")
+
+                while not self.stopped.is_set():
+                    message = pubsub.get_message(timeout=1.0)
+                    # Missing batches are requested on the first check after the LAST batch or once the hour went quiet, then on each deadline
+                    self.request_overdue_batches()
+
+                    if message is not None and message['type'] == 'pmessage':
+                        self.handle_data_message(message)
+
+            except redis.ConnectionError:
+                logging.error("INGESTER: Redis connection lost. Attempting to reconnect...")
+                self.stopped.wait(5)
+            except InfluxDBClientError:
+                logging.error("INGESTER: InfluxDB connection lost. Attempting to reconnect...")
+                self.stopped.wait(5)
+        if pubsub is not None:
+            pubsub.close()
+
+    def handle_ring_messages(self):
+        """
+        Consume batches handed over by a co-located Streamer through shared memory.
+        The Streamer waits while the ring is full so no batch is lost and no replay is requested.
+        Batches are released from the ring once every hour taken is written, so an Ingester
+        restarted after a crash reads the batches of its unfinished hour again.
+        """
+        committed_early = False
+        while not self.stopped.is_set():
+            item = self.data_ring.get(timeout=1.0, commit=False)
+            if item is not None:
+                channel, batch = item
+                self.handle_data_message({"type": "pmessage", "channel": channel, "data": batch})
+
+            if not self.hour_buffers:
+                self.data_ring.commit()
+                committed_early = False
+            elif self.data_ring.uncommitted() > self.data_ring.capacity // 2:
+                # Holding more would leave the Streamer waiting for space, the hour is not replayed after a crash
+                if not committed_early:
+                    logging.error("INGESTER: Hour larger than half the batch ring, releasing its batches before it is written")
+                    committed_early = True
+                self.data_ring.commit()
+
+    def record_shared_batch(self, batch_index, hour, message, shard=None):
+        """
+        Record a batch in the completion set of its hour and shard shared by all Ingester instances.
+        The instance that completes the hour's shard is the only one to record it as complete.
+        """
+        suffix = sharding.get_channel_suffix(shard)
+        key = f"weather_ingest:received:{hour}{suffix}"
+        expected_key = f"weather_ingest:expected:{hour}{suffix}"
+
+        pipe = self.r.pipeline()
+        if batch_index == "LAST":
+            num_batches = get_num_batches(message)
+            pipe.sadd(key, num_batches - 1)
+            pipe.set(expected_key, num_batches, ex=86400)
+        else:
+            pipe.sadd(key, int(batch_index))
+        pipe.expire(key, 86400)
+        pipe.scard(key)
+        pipe.get(expected_key)
+        received, expected = pipe.execute()[-2:]
+
+        # Only one instance can delete the completed set
+        if expected is not None and received >= int(expected) and self.r.delete(key):
+            self.r.delete(expected_key)
+            self.complete_hour(hour, shard)
+
+    def on_stream_batch_written(self, entry_id, batch_index, hour, message):
+        # The group shares every shard's batches, the shard comes from the channel rather than this instance
+        self.record_shared_batch(batch_index, hour, message, sharding.get_channel_shard(message['channel']))
+        # Acknowledged only once recorded, an entry redelivered after a failure is recorded again harmlessly
+        self.r.xack(messaging.DATA_STREAM, messaging.INGESTER_GROUP, entry_id)
+
+    def dead_letter_batch(self, entry_id, message, reason):
+        """Move a batch that can never be stored out of the group's pending entries, so it is not claimed again."""
+        logging.error(f"INGESTER: Moving stream entry {entry_id} to {messaging.DEAD_LETTER_STREAM}: {reason}")
+        try:
+            messaging.dead_letter(self.r, messaging.DATA_STREAM, messaging.INGESTER_GROUP, entry_id, message, reason)
+        except redis.ConnectionError:
+            logging.error(f"INGESTER: Failed to move stream entry {entry_id}, it will be claimed again")
+
+    def handle_stream_messages(self):
+        """
+        Consume batches from the data stream as part of the Ingester consumer group.
+        Each batch is written as soon as it arrives so instances can share the load,
+        and acknowledged only once it is stored. Unacknowledged batches are replayed
+        from the stream, so no replay requests are sent to the Streamer. Batches that
+        cannot be decoded or that InfluxDB rejects are moved to the dead letter stream.
+        """
+        # Named after the outage queue files, so a restarted instance replays its own pending batches
+        consumer = messaging.consumer_name(self.backup_prefix)
+
+        while not self.stopped.is_set():
+            try:
+                self.advertise_wire_format()
+                logging.info(f"INGESTER: Reading data stream as consumer {consumer}.")
+
+                for entry_id, message in messaging.read_stream(self.r, messaging.DATA_STREAM, messaging.INGESTER_GROUP, consumer):
+                    if self.stopped.is_set():
+                        break # Not acknowledged, the entry is replayed after a restart
+                    channel_name, type_message, batch_index, hour = get_parts(message['channel'])
+                    BATCHES_RECEIVED.inc()
+
+                    written = self.handle_message(message, partial(self.on_stream_batch_written, entry_id, batch_index, hour, message),
+                                                  on_rejected=partial(self.dead_letter_batch, entry_id, message, "rejected by InfluxDB"))
+                    if not written:
+                        self.dead_letter_batch(entry_id, message, "invalid batch")
+                    self.wait_for_writer()
+
+            except redis.ConnectionError:
+                logging.error("INGESTER: Redis connection lost. Attempting to reconnect...")
+                self.stopped.wait(5)
+
+
+if __name__ == "__main__":
+    # Initialize logging
+    logging.basicConfig(filename="logs.csv", level=logging.INFO, format="%(asctime)s, %(message)s")
+
+    ingester = Ingester().start()
+    metrics.serve(METRICS_PORT + (ingester.shard or 0) if METRICS_PORT else 0)
+
+    # Keep the main thread alive to maintain the background threads
+    try:
+        while True:
+            sleep(1)
+    except KeyboardInterrupt:
+        ingester.stop()
+        print("Shutting down...")
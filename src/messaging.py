@@ -0,0 +1,158 @@
+import os
+import socket
+import time
+import redis
+
+# Transport for the data and processor channels, "pubsub" or "streams"
+TRANSPORT = os.environ.get("WEATHER_TRANSPORT", "pubsub")
+
+# Streams replacing the weather_channel:data:* and weather_channel:processor:* channels
+DATA_STREAM = "weather_stream:data"
+PROCESSOR_STREAM = "weather_stream:processor"
+DEAD_LETTER_STREAM = "weather_stream:dead" # Entries that can never be processed, kept for inspection
+INGESTER_GROUP = "ingesters"
+PROCESSOR_GROUP = "processors"
+
+REDIS_HOST = os.environ.get("REDIS_HOST", "127.0.0.1")
+REDIS_PORT = int(os.environ.get("REDIS_PORT", 6379))
+REDIS_MAX_CONNECTIONS = int(os.environ.get("REDIS_MAX_CONNECTIONS", 32)) # Connections per process
+HEALTH_CHECK_INTERVAL = 30 # Seconds a connection may sit idle before it is checked with a PING
+PIPELINE_SIZE = int(os.environ.get("REDIS_PIPELINE_SIZE", 32)) # Publishes sent per round trip in bursts
+
+STREAM_MAXLEN = int(os.environ.get("WEATHER_STREAM_MAXLEN", 100000)) # Approximate number of entries kept per stream
+CLAIM_IDLE_MS = 60000 # Entries unacknowledged this long are taken over from dead consumers
+CLAIM_INTERVAL = 10 # Seconds between scans for such entries, whether or not new entries arrive
+
+
+pool = None
+
+
+def get_redis():
+    """Return a Redis client on the process's shared connection pool."""
+    global pool
+    if pool is None:
+        # A pool is not shared with forked children, redis-py resets it when the pid changes
+        pool = redis.ConnectionPool(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True,
+                                    max_connections=REDIS_MAX_CONNECTIONS, health_check_interval=HEALTH_CHECK_INTERVAL,
+                                    socket_keepalive=True)
+    return redis.Redis(connection_pool=pool)
+
+def use_streams():
+    """Return True if the data path runs over Redis Streams."""
+    return TRANSPORT == "streams"
+
+def consumer_name(instance=None):
+    """
+    Return a name identifying this consumer within a group. With an instance name unique on
+    the host the name survives restarts, so a restarted consumer replays its own pending entries.
+    """
+    return f"{socket.gethostname()}-{instance or os.getpid()}"
+
+def get_stream(channel):
+    """Return the stream carrying the given channel, or None if it stays on pub/sub."""
+    if channel.startswith("weather_channel:data:"):
+        return DATA_STREAM
+    if channel.startswith("weather_channel:processor:"):
+        return PROCESSOR_STREAM
+    return None
+
+def publish(r, channel, message):
+    """Publish a message on its channel, appending it to the matching stream in streams mode."""
+    stream = get_stream(channel) if use_streams() else None
+    if stream is None:
+        r.publish(channel, message)
+    else:
+        r.xadd(stream, {"channel": channel, "data": message}, maxlen=STREAM_MAXLEN, approximate=True)
+
+def publish_many(r, messages):
+    """
+    Publish (channel, message) pairs, PIPELINE_SIZE per round trip.
+    If Redis goes down midway the ConnectionError propagates and some of the messages may have been delivered.
+    """
+    pipe = r.pipeline(transaction=False)
+    for channel, message in messages:
+        publish(pipe, channel, message)
+        if len(pipe) >= PIPELINE_SIZE:
+            pipe.execute()
+    if len(pipe):
+        pipe.execute()
+
+def subscribe(r, patterns, pubsub=None):
+    """
+    Return a pub/sub connection subscribed to the patterns, reusing the given one.
+    A reused connection reconnects and subscribes again by itself, and is checked
+    with a PING when idle, so callers keep it across reconnect attempts.
+    """
+    if pubsub is None:
+        pubsub = r.pubsub()
+    missing = [pattern for pattern in patterns if pattern not in pubsub.patterns]
+    if missing:
+        pubsub.psubscribe(*missing)
+    return pubsub
+
+def ensure_group(r, stream, group):
+    """Create the consumer group (and the stream) if it does not exist yet."""
+    try:
+        r.xgroup_create(stream, group, id="0", mkstream=True)
+    except redis.ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+def to_message(fields):
+    """Shape a stream entry like a pub/sub message so existing handlers can process it."""
+    return {"type": "pmessage", "channel": fields["channel"], "data": fields["data"]}
+
+def dead_letter(r, stream, group, entry_id, message, reason):
+    """Move an entry that can never be processed to the dead letter stream and acknowledge it."""
+    pipe = r.pipeline()
+    pipe.xadd(DEAD_LETTER_STREAM, {"stream": stream, "id": entry_id, "channel": message["channel"],
+                                   "data": message["data"], "reason": reason},
+              maxlen=STREAM_MAXLEN, approximate=True)
+    pipe.xack(stream, group, entry_id)
+    pipe.execute()
+
+def read_stream(r, stream, group, consumer, count=100, block_ms=5000):
+    """
+    Yield (entry_id, message) pairs for a consumer in a group.
+
+    Entries this consumer received before a restart but never acknowledged are
+    replayed first. Entries left pending by idle consumers are then claimed every
+    CLAIM_INTERVAL seconds, count at a time from where the previous scan stopped,
+    so a busy stream does not delay them and stuck entries do not hide later ones.
+    Callers acknowledge entries with r.xack, or dead_letter those they cannot process.
+    """
+    ensure_group(r, stream, group)
+
+    # Replay this consumer's pending entries from the log
+    last_id = "0"
+    while True:
+        response = r.xreadgroup(group, consumer, {stream: last_id}, count=count)
+        entries = response[0][1] if response else []
+        if not entries:
+            break
+        for entry_id, fields in entries:
+            last_id = entry_id
+            if fields:
+                yield entry_id, to_message(fields)
+            else: # Trimmed from the stream, nothing left to process
+                r.xack(stream, group, entry_id)
+
+    claim_cursor = "0-0"
+    next_claim = 0
+    while True:
+        entries = []
+        if time.monotonic() >= next_claim:
+            # Take over entries from consumers that stopped without acknowledging
+            claim_cursor, entries = r.xautoclaim(stream, group, consumer, CLAIM_IDLE_MS, start_id=claim_cursor, count=count)[:2]
+            if claim_cursor == "0-0": # Scanned every pending entry, wait before the next scan
+                next_claim = time.monotonic() + CLAIM_INTERVAL
+
+        if not entries:
+            response = r.xreadgroup(group, consumer, {stream: ">"}, count=count, block=block_ms)
+            entries = response[0][1] if response else []
+
+        for entry_id, fields in entries:
+            if fields:
+                yield entry_id, to_message(fields)
+            else:
+                r.xack(stream, group, entry_id)
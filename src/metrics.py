@@ -0,0 +1,175 @@
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds of the histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+HOUR_LATENCY_BUCKETS = (1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 3600)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8" # Prometheus text exposition format
+
+registry = [] # Every metric created in this process, in creation order
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in pairs) + "}"
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    Base of the metrics, a value per combination of label values.
+
+    Updates take a lock held for a dictionary update, so they are cheap enough
+    for the per-batch paths. Metrics register themselves when created, at
+    module level, and render() reports every registered metric.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {} # Label values -> value
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def get_key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def collect(self):
+        """Return (suffix, label values, extra labels, value) samples."""
+        with self.lock:
+            return [("", key, (), value) for key, value in self.values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, key, extra, value in self.collect():
+            lines.append(f"{self.name}{suffix}{format_labels(self.labelnames, key, extra)} {format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    """Count of events since the process started."""
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Current value, set directly or read from a function when the metrics are collected."""
+
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def set_function(self, function, **labels):
+        """Report the return value of function, e.g. a queue's qsize, so the hot path does no bookkeeping."""
+        self.set(function, **labels)
+
+    def collect(self):
+        samples = []
+        for suffix, key, extra, value in super().collect():
+            if callable(value):
+                try:
+                    value = value()
+                except Exception as e:
+                    logging.error(f"METRICS: Failed to collect {self.name}: {e}")
+                    continue
+            samples.append((suffix, key, extra, value))
+        return samples
+
+
+class Histogram(Metric):
+    """Distribution of observed values, counted in cumulative buckets."""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.get_key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0] # Counts per bucket, sum, count
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def collect(self):
+        with self.lock:
+            states = [(key, list(counts), total, count) for key, (counts, total, count) in self.values.items()]
+        samples = []
+        for key, counts, total, count in states:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                samples.append(("_bucket", key, (("le", format_value(bound)),), cumulative))
+            samples.append(("_sum", key, (), total))
+            samples.append(("_count", key, (), count))
+        return samples
+
+
+def render():
+    """Return every registered metric in the Prometheus text format."""
+    lines = []
+    for metric in list(registry):
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Scrapes would flood logs.csv
+
+
+def serve(port, host="0.0.0.0"):
+    """
+    Serve /metrics for this process from a background thread, returning the server.
+    A port of 0 disables the endpoint, a port in use is logged and skipped.
+    """
+    if not port:
+        return None
+    try:
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError as e:
+        logging.error(f"METRICS: Unable to serve metrics on port {port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
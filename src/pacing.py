@@ -0,0 +1,32 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket limiting an operation to rate per second.
+
+    Up to burst tokens accumulate while the bucket is idle. A rate of 0 or
+    None disables the limit.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, rate or 0)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """Take tokens from the bucket, sleeping until they are available."""
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Tokens are reserved straight away, so concurrent callers queue up behind each other
+            self.tokens -= tokens
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
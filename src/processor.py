@@ -1,258 +1,587 @@
 from influxdb import InfluxDBClient
 import redis
 import logging
+import time
 from time import sleep
 import os
 import threading
-import queue
-
-# Initialize logging
-logging.basicConfig(filename="logs.csv", level=logging.INFO, format="%(asctime)s, %(message)s")
-
-# Initialize Redis client and InfluxDB client
-r = redis.Redis(host='127.0.0.1', port=6379, decode_responses=True)
-client = InfluxDBClient('localhost', 8086, 'root', 'root', 'myDB')
-
-pending_data = queue.Queue()
-
-def process_hourly_data(hour):
-    """
-    Calculate hourly analytics and attempt to store them in a separate measurement in InfluxDB.
-    """
-    start_time = f"2023-09-19T{hour:02d}:00:00Z"
-    end_time = f"2023-09-19T{hour + 1:02d}:00:00Z"
-
-    # Process state averages
-    state_averages = calculate_state_averages(start_time, end_time)
-
-    if hour < 10:
-        hour = f"0{hour}"
-
-    if state_averages:
-        send_analytics_to_influxdb(hour, state_averages, "weather_averages")
-    else:
-        print("No state averages data available")
-
-    # Process zip code extremes
-    zip_extremes = process_zip_extremes_by_state(start_time, end_time)
-    if zip_extremes:
-        send_analytics_to_influxdb(hour, zip_extremes, "zip_code_extremes")
-
-def calculate_state_averages(start_time, end_time):
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from datetime import datetime, timedelta
+import messaging
+from influx_writer import InfluxWriter
+from spill_queue import SpillQueue
+import hour_frames
+import metrics
+
+# Defaults, overridable through the environment
+NUM_WORKERS = int(os.environ.get("PROCESSOR_WORKERS", 4)) # Hours processed in parallel
+MAX_RETRIES = int(os.environ.get("PROCESSOR_MAX_RETRIES", 5))
+RETRY_BACKOFF = float(os.environ.get("PROCESSOR_RETRY_BACKOFF", 5)) # Seconds before the first retry, doubled on each retry
+BACKUP_DIR = "backup_data"
+METRICS_PORT = int(os.environ.get("PROCESSOR_METRICS_PORT", 9102)) # 0 disables the metrics endpoint
+METRICS = ['temp_c', 'pressure_mb', 'humidity', 'precip_mm'] # Fields the analytics are computed for
+
+HOUR_LATENCY = metrics.Histogram("weather_hour_latency_seconds", "Time from the first publish of an hour to its analytics being written",
+                                 buckets=metrics.HOUR_LATENCY_BUCKETS)
+HOUR_DURATION = metrics.Histogram("weather_hour_processing_seconds", "Time spent computing and writing the analytics of an hour",
+                                  buckets=metrics.HOUR_LATENCY_BUCKETS)
+HOURS_PROCESSED = metrics.Counter("weather_hours_processed_total", "Hours the Processor finished, by result", ["result"])
+HOUR_RETRIES = metrics.Counter("weather_hour_retries_total", "Hours scheduled again after producing no analytics")
+SCHEDULED_HOURS = metrics.Gauge("weather_processor_hours", "Hours waiting for a worker or running", ["state"])
+PENDING_DEPTH = metrics.Gauge("weather_processor_pending_batches", "Analytics batches queued while InfluxDB is down")
+
+
+def calculate_state_averages(start_time, end_time, client):
     """
     Calculate average temperature, pressure, humidity, and precipitation per state.
     
     Parameters:
         start_time (str): The start time in ISO 8601 format.
         end_time (str): The end time in ISO 8601 format.
+        client (InfluxDBClient): The InfluxDB client instance.
         
     Returns:
-        list: A list of dictionaries containing average metrics for each state.
+        list: A list of dictionaries containing all average metrics for each state.
     """
-    metrics = ['temp_c', 'pressure_mb', 'humidity', 'precip_mm']
-
-    queries = get_queries_state_averages(metrics, start_time, end_time)
-    state_averages = get_state_averages(queries, client, metrics)
+    query = get_query_state_averages(METRICS, start_time, end_time)
+    state_averages = get_state_averages(query, client, METRICS)
  
     return state_averages
 
 
-def get_queries_state_averages(metrics, start_time, end_time):
+def get_query_state_averages(metric_names, start_time, end_time):
     """
-    Generate queries to calculate average metrics per state.
+    Generate a single query calculating the average of every metric per state over the hour.
     
     Parameters:
-        metrics (list): List of metrics to calculate averages for.
+        metric_names (list): List of metrics to calculate averages for.
         start_time (str): The start time in ISO 8601 format.
         end_time (str): The end time in ISO 8601 format.
         
     Returns:
-        list: A list of InfluxDB queries.
+        str: An InfluxDB query.
     """
-    queries = []
-    for metric in metrics:
-        query = f"""
-        SELECT MEAN({metric}) AS avg_{metric} FROM weather_data
-        WHERE time = '{start_time}'
+    fields = ", ".join(f"MEAN({metric}) AS avg_{metric}" for metric in metric_names)
+    return f"""
+        SELECT {fields} FROM weather_data
+        WHERE time >= '{start_time}' AND time < '{end_time}'
         GROUP BY state
         """
-        queries.append(query)
-    return queries
 
 
-def get_state_averages(queries, client, metrics):
+def get_state_averages(query, client, metric_names):
     """
-    Fetch the results of state average queries from InfluxDB.
+    Fetch the results of the state averages query from InfluxDB.
     
     Parameters:
-        queries (list): List of InfluxDB queries for state averages.
+        query (str): InfluxDB query for state averages.
         client (InfluxDBClient): The InfluxDB client instance.
-        metrics (list): List of metrics being queried.
+        metric_names (list): List of metrics being queried.
         
     Returns:
-        list: A list of dictionaries containing average values for each state.
+        list: A list of dictionaries containing the average values of every metric for each state.
     """
     state_averages = []
     try:
-        for metric, query in zip(metrics, queries):
+        result = client.query(query)
+        for group_key, points in result.items():
             
-            result = client.query(query)
-            for group_key, points in result.items():
-                
-                state = group_key[1].get('state')
-                points_list = list(points)
-
-                for points in points_list:
-                    avg_value = points.get(f"avg_{metric}")
-                    state_averages.append({
-                            "state": state,
-                            f"avg_{metric}": avg_value
-                    })
+            state = group_key[1].get('state')
+
+            for point in points:
+                averages = {f"avg_{metric}": point.get(f"avg_{metric}") for metric in metric_names}
+                state_averages.append({
+                        "state": state,
+                        # Fields without a value would fail the write
+                        **{key: value for key, value in averages.items() if value is not None}
+                })
         return state_averages
     except Exception as e:
         logging.error(f"PROCESSOR: InfluxDB query failed: {e}")
         return []
 
 
-def process_zip_extremes_by_state(start_time, end_time):
+def process_zip_extremes_by_state(start_time, end_time, client):
     """
     Process zip codes with the lowest and highest metrics (temperature, pressure, humidity, precipitation)
-    within a given state.
+    within each state.
     """
-    metrics = ['temp_c', 'pressure_mb', 'humidity', 'precip_mm']
-    states = get_all_states()  # Retrieves all states, including DC
-    zip_extremes = []
+    query = get_query_zip_extremes(METRICS, start_time, end_time)
+    zip_values = get_zip_extremes(query, client)
+    return reduce_zip_extremes(zip_values, METRICS)
 
-    for state in states:
-        min_queries, max_queries = get_queries_zip_extremes(metrics, start_time, end_time, state)
-        extremes = calculate_extremes(min_queries, max_queries, client, metrics)
-        for extreme in extremes:
-            extreme["state"] = state  # Add the state context to each extreme
-        zip_extremes.extend(extremes)
-    return zip_extremes
 
-
-def get_queries_zip_extremes(metrics, start_time, end_time, state):
-    """
-    Generate queries to find zip codes with the lowest and highest values for each metric within a state.
+def get_query_zip_extremes(metric_names, start_time, end_time):
     """
-    min_queries = []
-    max_queries = []
-    for metric in metrics:
-        min_queries.append(f"""
-            SELECT MIN({metric}) AS min_{metric}, zip_code 
-            FROM weather_data
-            WHERE time >= '{start_time}' AND time < '{end_time}' AND "state" = '{state}'
-            GROUP BY zip_code
-        """)
-        max_queries.append(f"""
-            SELECT MAX({metric}) AS max_{metric}, zip_code 
-            FROM weather_data
-            WHERE time >= '{start_time}' AND time < '{end_time}' AND "state" = '{state}'
-            GROUP BY zip_code
-        """)
-    return (min_queries, max_queries)
-
-
-def get_all_states():
+    Generate a single query returning the lowest and highest value of every metric for each zip code of each state.
     """
-    Retrieve a list of all states (including DC) from the database.
+    fields = ", ".join(f"MIN({metric}) AS min_{metric}, MAX({metric}) AS max_{metric}" for metric in metric_names)
+    return f"""
+        SELECT {fields}
+        FROM weather_data
+        WHERE time >= '{start_time}' AND time < '{end_time}'
+        GROUP BY state, zip_code
     """
-    query = 'SHOW TAG VALUES FROM weather_data WITH KEY = "state"'
-    result = client.query(query)
-    states = [item["value"] for item in result.get_points()]
-    return states
 
 
-def calculate_extremes(min_queries, max_queries, client, metrics):
+def get_zip_extremes(query, client):
     """
-    Extract the results of min and max queries for extremes calculation.
+    Fetch the per zip code extremes from InfluxDB.
+
+    Returns:
+        DataFrame: One row per (state, zip_code) with a min_ and max_ column per metric.
     """
-    extremes = []
+    rows = []
     try:
-        # Process min queries
-        for metric, query in zip(metrics, min_queries):
-            result = client.query(query)
-            for group_key, points in result.items():
-                zip_code = group_key[1].get('zip_code')
-                points_list = list(points)
-                if points_list:
-                    value = points_list[0].get(f"min_{metric}")
-                    if value is not None:
-                        extremes.append({"zip_code": zip_code, f"min_{metric}": value})
-
-        # Process max queries
-        for metric, query in zip(metrics, max_queries):
-            result = client.query(query)
-            for group_key, points in result.items():
-                zip_code = group_key[1].get('zip_code') 
-                points_list = list(points)
-                if points_list:
-                    value = points_list[0].get(f"max_{metric}")
-                    if value is not None:
-                        extremes.append({"zip_code": zip_code, f"max_{metric}": value})
-
+        result = client.query(query)
+        for group_key, points in result.items():
+            tags = group_key[1]
+            for point in points:
+                point.pop("time", None)
+                rows.append({"state": tags.get('state'), "zip_code": tags.get('zip_code'), **point})
     except Exception as e:
         logging.error(f"PROCESSOR: InfluxDB query failed: {e}")
-    return extremes
+    return pd.DataFrame(rows)
+
 
-def send_analytics_to_influxdb(hour, analytics_data, measurement):
+def reduce_zip_extremes(zip_values, metric_names):
     """
-    Save analytics results (averages or extremes) to InfluxDB.
+    Keep, for each state and metric, the zip code with the lowest minimum and the one with the highest maximum.
+
+    Parameters:
+        zip_values (DataFrame): One row per (state, zip_code) with min_ and max_ columns per metric.
+        metric_names (list): List of metrics.
+
+    Returns:
+        list: One dictionary per extreme zip code of a state, holding the extremes it is the zip code for.
     """
-    points = []
-    for data in analytics_data:
-        fields = {k: v for k, v in data.items() if k not in ["zip_code", "state"]}
-        tags = {"hour": hour}
-        if "zip_code" in data:
-            tags["zip_code"] = data["zip_code"]
-        if "state" in data:
-            tags["state"] = data["state"]
-
-        points.append({
-            "measurement": measurement,
-            "tags": tags,
-            "fields": fields,
-            "time": f"2023-09-19T{hour}:00:00Z"
+    extremes = {}
+    if zip_values.empty:
+        return []
+
+    for metric in metric_names:
+        for column, select in ((f"min_{metric}", "idxmin"), (f"max_{metric}", "idxmax")):
+            values = zip_values[["state", column]].dropna()
+            if values.empty:
+                continue
+            rows = zip_values.loc[getattr(values.groupby("state")[column], select)()]
+            for state, zip_code, value in zip(rows["state"].tolist(), rows["zip_code"].tolist(), rows[column].tolist()):
+                extreme = extremes.setdefault((state, zip_code), {"state": state, "zip_code": zip_code})
+                extreme[column] = value
+    return list(extremes.values())
+
+
+def calculate_state_rankings(state_averages):
+    """
+    Find the states with the highest and lowest average of each metric.
+
+    Returns:
+        list: A single record with max_/min_ fields per metric and the matching max_/min_<metric>_state fields.
+    """
+    rankings = {}
+    for metric in METRICS:
+        values = [(average[f"avg_{metric}"], average["state"]) for average in state_averages if f"avg_{metric}" in average]
+        if not values:
+            continue
+        max_value, max_state = max(values)
+        min_value, min_state = min(values)
+        rankings.update({
+            f"max_{metric}": max_value, f"max_{metric}_state": max_state,
+            f"min_{metric}": min_value, f"min_{metric}_state": min_state
         })
+    return [rankings] if rankings else []
 
-    try:
-        client.write_points(points)
-        logging.info(f"PROCESSOR: Successfully wrote analytics to InfluxDB for hour {hour} into {measurement}")
-    
-    except Exception as e:
-        logging.error(f"PROCESSOR: InfluxDB write failed: {e}")
-        pending_data.put(points)
 
-def handle_incoming_messages():
-    """Listen for Ingester notifications and start processing received data."""
-    while True:
+def calculate_frame_state_averages(frame):
+    """
+    Calculate the average of every metric per state from the hour's raw data.
+
+    Returns:
+        list: A list of dictionaries containing the average values of every metric for each state.
+    """
+    averages = frame.groupby("state")[METRICS].mean()
+    averages.columns = [f"avg_{metric}" for metric in METRICS]
+
+    state_averages = []
+    for state, row in zip(averages.index.tolist(), averages.to_dict("records")):
+        state_averages.append({"state": state, **{key: value for key, value in row.items() if pd.notna(value)}})
+    return state_averages
+
+
+def calculate_frame_zip_extremes(frame):
+    """
+    Process zip codes with the lowest and highest metrics within each state from the hour's raw data.
+    """
+    zip_values = frame.groupby(["state", "zip_code"])[METRICS].agg(["min", "max"])
+    zip_values.columns = [f"{function}_{metric}" for metric, function in zip_values.columns]
+    return reduce_zip_extremes(zip_values.reset_index(), METRICS)
+
+
+class HourScheduler:
+    """
+    Runs hour jobs on a thread pool.
+
+    A notification for an hour that is already queued is dropped, one arriving
+    while the hour runs schedules a single rerun once it finishes. Failed hours
+    are retried with exponential backoff. Callbacks passed to submit are called
+    with the final result once the hour is done.
+    """
+
+    def __init__(self, job, workers=NUM_WORKERS, retries=MAX_RETRIES, backoff=RETRY_BACKOFF):
+        self.job = job
+        self.retries = retries
+        self.backoff = backoff
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hour-job")
+        self.lock = threading.Lock()
+        self.queued = set()  # Hours waiting for a worker or for a retry
+        self.running = set()
+        self.rerun = set()  # Hours notified again while running
+        self.callbacks = {}  # hour -> callbacks to call once it is done
+        self.timers = set()  # Retries waiting for their backoff delay
+        self.stopped = False
+        SCHEDULED_HOURS.set_function(lambda: len(self.queued), state="queued")
+        SCHEDULED_HOURS.set_function(lambda: len(self.running), state="running")
+
+    def submit(self, hour, on_done=None):
+        """Schedule an hour, returning False if the notification was merged with a pending run."""
+        with self.lock:
+            if on_done:
+                self.callbacks.setdefault(hour, []).append(on_done)
+            if hour in self.queued:
+                logging.info(f"PROCESSOR: Hour {hour} already scheduled, ignoring repeated notification")
+                return False
+            if hour in self.running:
+                self.rerun.add(hour)
+                return False
+            if self.stopped:
+                return False
+            self.queued.add(hour)
+        self.executor.submit(self.run, hour, 0)
+        return True
+
+    def stop(self):
+        """Cancel the retries and hours still waiting for a worker and wait for the running ones."""
+        with self.lock:
+            self.stopped = True
+            timers, self.timers = self.timers, set()
+        for timer in timers:
+            timer.cancel()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def retry(self, hour, attempt, timer):
+        """Run an hour again once its backoff delay has passed, unless the scheduler was stopped meanwhile."""
+        with self.lock:
+            self.timers.discard(timer)
+            if self.stopped:
+                return
+            try:
+                self.executor.submit(self.run, hour, attempt)
+            except RuntimeError: # Shut down between the check and the submit
+                pass
+
+    def run(self, hour, attempt):
+        with self.lock:
+            self.queued.discard(hour)
+            self.running.add(hour)
+
+        started = time.perf_counter()
         try:
-            pubsub = r.pubsub()
-            pubsub.psubscribe("weather_channel:processor:*")
-            logging.info("PROCESSOR: Subscribed to Ingester notifications.")
-            success = True
-            for message in pubsub.listen():
-                if message['type'] == 'pmessage':
-                    channel = message['channel']
-                    if channel.startswith("weather_channel:processor:"):
-                        hour = int(message['data'])
-                        logging.info(f"PROCESSOR: Received notification to process data for hour {hour}")
-                        process_hourly_data(hour)
-                
+            success = self.job(hour)
+        except Exception as e:
+            logging.error(f"PROCESSOR: Processing hour {hour} failed: {e}")
+            success = False
+        HOUR_DURATION.observe(time.perf_counter() - started)
+
+        with self.lock:
+            self.running.discard(hour)
+            if not success and attempt < self.retries:
+                delay = self.backoff * 2 ** attempt
+                logging.info(f"PROCESSOR: Retrying hour {hour} in {delay} seconds")
+                HOUR_RETRIES.inc()
+                self.queued.add(hour)
+                if not self.stopped:
+                    retry = threading.Timer(delay, lambda: self.retry(hour, attempt + 1, retry))
+                    retry.daemon = True
+                    self.timers.add(retry)
+                    retry.start()
+                return
+
+            if not success:
+                logging.error(f"PROCESSOR: Giving up on hour {hour} after {attempt + 1} attempts")
+            HOURS_PROCESSED.inc(result="ok" if success else "failed")
+            callbacks = self.callbacks.pop(hour, [])
+            rerun = hour in self.rerun
+            self.rerun.discard(hour)
+
+        for callback in callbacks:
+            callback(success)
+        if rerun:
+            self.submit(hour)
+
+
+class Processor:
+    """
+    Computes the analytics of every hour the Ingester completes and writes them to InfluxDB.
+
+    Nothing is connected or opened until start(): the Redis and InfluxDB clients
+    are created on first use unless they are passed in, and the InfluxDB writer
+    starts its workers on the first write. With a notify_ring the notifications
+    come from a co-located Ingester through shared memory instead of Redis.
+    """
+
+    def __init__(self, workers=NUM_WORKERS, retries=MAX_RETRIES, backoff=RETRY_BACKOFF, transport=None,
+                 local_engine=None, backup_dir=BACKUP_DIR, redis_client=None, influx_client=None, writer=None,
+                 notify_ring=None):
+        self.streams = messaging.use_streams() if transport is None else transport == "streams"
+        self.local_engine = hour_frames.use_local_engine() if local_engine is None else local_engine
+        self.backup_dir = backup_dir
+        self.redis_client = redis_client
+        self.influx_client = influx_client
+        self.writer = writer or InfluxWriter(name="PROCESSOR", on_error=self.on_write_error)
+        self.notify_ring = notify_ring
+        self.scheduler = HourScheduler(self.process_hourly_data, workers, retries, backoff)
+        self.pending_data = None # Analytics not written while InfluxDB is down, opened by start()
+        self.ring_notifications = {} # Ring position after each notification taken -> whether its hour is done
+        self.ring_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.threads = []
+
+    @property
+    def r(self):
+        if self.redis_client is None:
+            self.redis_client = messaging.get_redis()
+        return self.redis_client
+
+    @property
+    def client(self):
+        if self.influx_client is None:
+            self.influx_client = InfluxDBClient('localhost', 8086, 'root', 'root', 'myDB')
+        return self.influx_client
+
+    def start(self):
+        """Open the outage queue and start handling the Ingester's notifications."""
+        if self.threads:
+            return self
+        self.stopped.clear()
+        self.pending_data = SpillQueue(os.path.join(self.backup_dir, "processor_pending.log"))
+        PENDING_DEPTH.set_function(self.pending_data.qsize)
+        if self.notify_ring is not None:
+            handler = self.handle_ring_messages
+        else:
+            handler = self.handle_stream_messages if self.streams else self.handle_incoming_messages
+        for target in [handler, self.pending_data_thread_handler]:
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def stop(self, timeout=5):
+        """Stop listening, finish the running hours, write what is queued and move the outage queue to disk."""
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+        self.scheduler.stop()
+        self.writer.stop(timeout)
+        if self.pending_data is not None:
+            self.pending_data.close()
+        logging.info("PROCESSOR: Shutting down.")
+
+    def on_write_error(self, lines):
+        """Called by the writer when InfluxDB stays unreachable after retries."""
+        self.pending_data.put(lines)
+
+    def process_hourly_data(self, hour):
+        """
+        Calculate hourly analytics and attempt to store them in a separate measurement in InfluxDB.
+        Returns False if no analytics could be calculated, so the hour can be retried.
+        """
+        start = datetime(2023, 9, 19, hour)
+        start_time = start.strftime("%Y-%m-%dT%H:%M:%SZ")
+        end_time = (start + timedelta(hours=1)).strftime("%Y-%m-%dT%H:%M:%SZ") # Next day for hour 23
+
+        # Use the frame handed over by the Ingester when available, instead of reading the hour back
+        frame = hour_frames.load_hour_frame(hour) if self.local_engine else None
+        if frame is not None:
+            logging.info(f"PROCESSOR: Computing analytics for hour {hour} from the Ingester's frame")
+
+        # Process state averages
+        if frame is not None:
+            state_averages = calculate_frame_state_averages(frame)
+        else:
+            state_averages = calculate_state_averages(start_time, end_time, self.client)
+
+        padded_hour = f"{hour:02d}"
+
+        if state_averages:
+            self.send_analytics_to_influxdb(padded_hour, state_averages, "weather_averages")
+            self.send_analytics_to_influxdb(padded_hour, calculate_state_rankings(state_averages), "state_rankings")
+        else:
+            print("No state averages data available")
+
+        # Process zip code extremes
+        if frame is not None:
+            zip_extremes = calculate_frame_zip_extremes(frame)
+        else:
+            zip_extremes = process_zip_extremes_by_state(start_time, end_time, self.client)
+        if zip_extremes:
+            self.send_analytics_to_influxdb(padded_hour, zip_extremes, "zip_code_extremes")
+
+        if frame is not None:
+            hour_frames.remove_hour_frame(hour)
+
+        if state_averages:
+            self.notify_analytics_written(padded_hour)
+        return bool(state_averages)
+
+    def notify_analytics_written(self, hour):
+        """Tell API instances the analytics for the hour are stored, so they refresh their cache."""
+        self.writer.flush()
+        try:
+            self.r.publish(f"weather_channel:analytics:{hour}", hour)
+            # Stored by the Streamer when it started publishing the hour
+            started = self.r.get(f"weather_metrics:hour_started:{int(hour)}")
+            if started is not None:
+                HOUR_LATENCY.observe(max(0.0, time.time() - float(started)))
         except redis.ConnectionError:
-            logging.error("PROCESSOR: Redis connection lost. Attempting to reconnect...")
-            sleep(5)
+            logging.error(f"PROCESSOR: Failed to announce analytics for hour {hour}")
 
+    def send_analytics_to_influxdb(self, hour, analytics_data, measurement):
+        """
+        Save analytics results (averages or extremes) to InfluxDB.
+        """
+        points = []
+        for data in analytics_data:
+            fields = {k: v for k, v in data.items() if k not in ["zip_code", "state"]}
+            tags = {"hour": hour}
+            if "zip_code" in data:
+                tags["zip_code"] = data["zip_code"]
+            if "state" in data:
+                tags["state"] = data["state"]
+
+            points.append({
+                "measurement": measurement,
+                "tags": tags,
+                "fields": fields,
+                "time": f"2023-09-19T{hour}:00:00Z"
+            })
+
+        def on_written():
+            logging.info(f"PROCESSOR: Successfully wrote analytics to InfluxDB for hour {hour} into {measurement}")
+
+        if not self.writer.submit(points, on_written):
+            self.pending_data.put(points)
+
+    def send_pending_data(self):
+        """Resend analytics queued while InfluxDB was down."""
+        if self.pending_data.empty():
+            return
+        if self.writer.online or self.writer.ping():
+            sent = self.pending_data.drain(self.writer.submit)
+            logging.info(f"PROCESSOR: Resent {sent} pending analytics batches to InfluxDB.")
+        else:
+            logging.error(f"PROCESSOR: InfluxDB still down, keeping {self.pending_data.qsize()} pending analytics batches")
+
+    def pending_data_thread_handler(self):
+        while not self.stopped.is_set():
+            self.send_pending_data()
+            self.stopped.wait(15)
+
+    def handle_incoming_messages(self):
+        """Listen for Ingester notifications and start processing received data."""
+        pubsub = None
+        while not self.stopped.is_set():
+            try:
+                pubsub = messaging.subscribe(self.r, ["weather_channel:processor:*"], pubsub)
+                logging.info("PROCESSOR: Subscribed to Ingester notifications.")
+                while not self.stopped.is_set():
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is not None and message['type'] == 'pmessage':
+                        channel = message['channel']
+                        if channel.startswith("weather_channel:processor:"):
+                            hour = int(message['data'])
+                            logging.info(f"PROCESSOR: Received notification to process data for hour {hour}")
+                            self.scheduler.submit(hour)
+
+            except redis.ConnectionError:
+                logging.error("PROCESSOR: Redis connection lost. Attempting to reconnect...")
+                self.stopped.wait(5)
+        if pubsub is not None:
+            pubsub.close()
+
+    def handle_ring_messages(self):
+        """
+        Take notifications from a co-located Ingester through shared memory.
+        A notification is released from the ring once its hour and every earlier one is done,
+        so a Processor restarted after a crash handles the hours it was working on again.
+        """
+        while not self.stopped.is_set():
+            item = self.notify_ring.get(timeout=1.0, commit=False)
+            if item is not None:
+                hour = int(item[1])
+                position = self.notify_ring.cursor
+                with self.ring_lock:
+                    self.ring_notifications[position] = False
+                logging.info(f"PROCESSOR: Received notification to process data for hour {hour}")
+                self.scheduler.submit(hour, partial(self.on_ring_hour_done, position))
+            self.commit_ring_notifications()
+
+    def on_ring_hour_done(self, position, success):
+        with self.ring_lock:
+            self.ring_notifications[position] = True
+
+    def commit_ring_notifications(self):
+        """Release the notifications taken from the ring up to the first whose hour is not done."""
+        committed = None
+        with self.ring_lock:
+            for position, done in list(self.ring_notifications.items()): # In the order they were taken
+                if not done:
+                    break
+                del self.ring_notifications[position]
+                committed = position
+        if committed is not None:
+            self.notify_ring.commit(committed)
+
+    def handle_stream_messages(self):
+        """Consume Ingester notifications from the processor stream as part of the Processor consumer group."""
+        consumer = messaging.consumer_name()
+        while not self.stopped.is_set():
+            try:
+                logging.info(f"PROCESSOR: Reading notification stream as consumer {consumer}.")
+                for entry_id, message in messaging.read_stream(self.r, messaging.PROCESSOR_STREAM, messaging.PROCESSOR_GROUP, consumer):
+                    if self.stopped.is_set():
+                        break # Not acknowledged, the entry is replayed after a restart
+                    try:
+                        hour = int(message['data'])
+                    except ValueError:
+                        logging.error(f"PROCESSOR: Invalid notification {message['data']!r}, moving it to {messaging.DEAD_LETTER_STREAM}")
+                        messaging.dead_letter(self.r, messaging.PROCESSOR_STREAM, messaging.PROCESSOR_GROUP, entry_id, message, "invalid hour")
+                        continue
+                    logging.info(f"PROCESSOR: Received notification to process data for hour {hour}")
+                    # Acknowledged once the hour is done, a failed hour has already been retried
+                    self.scheduler.submit(hour, partial(self.ack_notification, entry_id))
 
-channel_handler = threading.Thread(target=handle_incoming_messages, daemon=True)
-channel_handler.start()
+            except redis.ConnectionError:
+                logging.error("PROCESSOR: Redis connection lost. Attempting to reconnect...")
+                self.stopped.wait(5)
 
-# Keep the main thread alive to maintain the background threads
-try:
-    while True:
-        sleep(1)
-except KeyboardInterrupt:
-    logging.info("STREAMER: Shutting down.")
-    print("Shutting down...")
+    def ack_notification(self, entry_id, success):
+        self.r.xack(messaging.PROCESSOR_STREAM, messaging.PROCESSOR_GROUP, entry_id)
 
+
+if __name__ == "__main__":
+    # Initialize logging
+    logging.basicConfig(filename="logs.csv", level=logging.INFO, format="%(asctime)s, %(message)s")
+
+    processor = Processor().start()
+    metrics.serve(METRICS_PORT)
+
+    # Keep the main thread alive to maintain the background threads
+    try:
+        while True:
+            sleep(1)
+    except KeyboardInterrupt:
+        processor.stop()
+        print("Shutting down...")
@@ -0,0 +1,176 @@
+import pickle
+import struct
+import threading
+import time
+from multiprocessing import shared_memory
+
+HEADER = struct.Struct("<QQ") # Bytes written and bytes read since the ring was created
+RECORD_HEADER = struct.Struct("<I") # Length of each record
+BUFFER_COUNT = struct.Struct("<I") # Out of band buffers of a pickled item, followed by the pickle's and their lengths
+POLL_INTERVAL = 0.001 # Seconds between checks of an empty or full ring
+
+
+class RingBuffer:
+    """
+    Single producer, single consumer queue of records in shared memory.
+
+    The producer copies each record into the ring once and the consumer unpickles
+    it straight from the shared buffer, so moving a batch between co-located
+    processes costs neither a socket round trip nor a text encoding. Numpy arrays
+    are pickled out of band: their memory is copied into the ring as raw bytes and
+    copied back into new arrays, without converting each value. Positions are
+    kept in the shared header, so a restarted consumer resumes where the previous
+    one stopped. A consumer can take records without committing them, they then
+    stay in the ring and are read again after a restart until commit() is called.
+    Create the ring before forking the processes that use it.
+    """
+
+    def __init__(self, size=64 * 1024 * 1024, name=None, create=True):
+        self.shm = shared_memory.SharedMemory(name=name, create=create, size=size + HEADER.size if create else 0)
+        self.buffer = self.shm.buf
+        self.capacity = self.shm.size - HEADER.size
+        if create:
+            HEADER.pack_into(self.buffer, 0, 0, 0)
+        # Serialize the threads of one process, the ring has one producer and one consumer process
+        self.put_lock = threading.Lock()
+        self.get_lock = threading.Lock()
+        self.cursor = 0 # Position of the next record this consumer reads, ahead of the shared read position until committed
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def positions(self):
+        return HEADER.unpack_from(self.buffer, 0)
+
+    def qsize(self):
+        """Return the number of bytes waiting to be read."""
+        written, read = self.positions()
+        return written - read
+
+    def copy_in(self, position, data):
+        offset = position % self.capacity
+        first = min(len(data), self.capacity - offset)
+        self.buffer[HEADER.size + offset:HEADER.size + offset + first] = data[:first]
+        if first < len(data): # Wraps around to the start of the ring
+            self.buffer[HEADER.size:HEADER.size + len(data) - first] = data[first:]
+
+    def copy_out(self, position, length):
+        offset = position % self.capacity
+        first = min(length, self.capacity - offset)
+        if first == length:
+            return self.buffer[HEADER.size + offset:HEADER.size + offset + length]
+        return bytes(self.buffer[HEADER.size + offset:HEADER.size + self.capacity]) + \
+            bytes(self.buffer[HEADER.size:HEADER.size + length - first])
+
+    def put_bytes(self, data, timeout=None):
+        """Append a record, waiting while the ring is full. Returns False if it stayed full past the timeout."""
+        return self.put_parts([data], timeout)
+
+    def put_parts(self, parts, timeout=None):
+        """Append a record made of several byte strings or buffers, copied into the ring one after the other."""
+        length = sum(len(part) for part in parts)
+        size = RECORD_HEADER.size + length
+        if size > self.capacity:
+            raise ValueError(f"Record of {length} bytes does not fit in a ring of {self.capacity} bytes")
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.put_lock:
+            while True:
+                written, read = self.positions()
+                if self.capacity - (written - read) >= size:
+                    break
+                if deadline is not None and time.monotonic() >= deadline:
+                    return False
+                time.sleep(POLL_INTERVAL)
+
+            self.copy_in(written, RECORD_HEADER.pack(length))
+            position = written + RECORD_HEADER.size
+            for part in parts:
+                self.copy_in(position, part)
+                position += len(part)
+            # Published last, the consumer only sees complete records
+            struct.pack_into("<Q", self.buffer, 0, written + size)
+        return True
+
+    def uncommitted(self):
+        """Return the number of bytes this consumer has taken but not committed."""
+        return max(0, self.cursor - self.positions()[1])
+
+    def get_bytes(self, timeout=None):
+        """
+        Return the oldest record not taken yet, as a view of the shared buffer unless it wraps around,
+        and the read position following it, or None if the ring stayed empty past the timeout. The
+        record stays in the ring until the read position is stored.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            written, read = self.positions()
+            read = max(read, self.cursor) # A restarted consumer starts again from the committed position
+            if written > read:
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(POLL_INTERVAL)
+
+        length, = RECORD_HEADER.unpack(bytes(self.copy_out(read, RECORD_HEADER.size)))
+        return self.copy_out(read + RECORD_HEADER.size, length), read + RECORD_HEADER.size + length
+
+    def put(self, item, timeout=None):
+        """Append a picklable item, see put_bytes."""
+        buffers = []
+        data = pickle.dumps(item, protocol=5, buffer_callback=buffers.append)
+        views = [buffer.raw() for buffer in buffers]
+        lengths = BUFFER_COUNT.pack(len(views)) + struct.pack(f"<{len(views) + 1}Q", len(data), *(len(view) for view in views))
+        return self.put_parts([lengths, data, *views], timeout)
+
+    def load(self, data):
+        """Unpickle an item stored by put, copying its out of band buffers out of the shared buffer."""
+        data = memoryview(data)
+        count, = BUFFER_COUNT.unpack_from(data, 0)
+        lengths = struct.unpack_from(f"<{count + 1}Q", data, BUFFER_COUNT.size)
+        offset = BUFFER_COUNT.size + 8 * (count + 1)
+        buffers = []
+        for length in lengths[1:]:
+            start = offset + lengths[0] + sum(len(buffer) for buffer in buffers)
+            buffers.append(bytearray(data[start:start + length]))
+        with data[offset:offset + lengths[0]] as pickled:
+            item = pickle.loads(pickled, buffers=buffers)
+        data.release()
+        return item
+
+    def get(self, timeout=None, commit=True):
+        """
+        Take and return the oldest item, or None if the ring stayed empty past the timeout.
+        Without commit the item stays in the ring until commit() is called.
+        """
+        with self.get_lock:
+            record = self.get_bytes(timeout)
+            if record is None:
+                return None
+            data, end = record
+            item = self.load(data)
+            if isinstance(data, memoryview):
+                data.release()
+            self.cursor = end
+            if commit: # Released only once the item is copied out of the shared buffer
+                struct.pack_into("<Q", self.buffer, 8, end)
+            return item
+
+    def commit(self, position=None):
+        """
+        Release the items taken up to position, the value of cursor after taking the last of them,
+        or every item taken so far by default. Released items are not read again after a restart.
+        """
+        with self.get_lock:
+            position = self.cursor if position is None else min(position, self.cursor)
+            if position > self.positions()[1]:
+                struct.pack_into("<Q", self.buffer, 8, position)
+
+    def close(self):
+        self.buffer.release()
+        self.shm.close()
+
+    def unlink(self):
+        """Free the shared memory, called by the process that created the ring once everyone is done."""
+        self.shm.unlink()
@@ -0,0 +1,42 @@
+import os
+import zlib
+import numpy as np
+
+# Number of shards the ingest path is split into, each consumed by its own Ingester
+NUM_SHARDS = int(os.environ.get("WEATHER_SHARDS", 1))
+
+# Column whose hash picks the shard of a row, "state" or "zip_code"
+SHARD_KEY = os.environ.get("WEATHER_SHARD_KEY", "state")
+
+
+def get_shards(num_shards):
+    """Return the shards to publish, [None] when the ingest path is not sharded."""
+    return list(range(num_shards)) if num_shards > 1 else [None]
+
+def get_shard(value, num_shards):
+    """Return the shard of a key value, stable across processes unlike hash()."""
+    return zlib.crc32(str(value).encode()) % num_shards
+
+def split_frame(frame, num_shards, key=SHARD_KEY):
+    """Return the rows of the frame in one frame per shard, keeping their order."""
+    if num_shards <= 1:
+        return [frame]
+    if frame.empty:
+        return [frame] * num_shards
+    if key not in frame.columns:
+        raise ValueError(f"Shard key '{key}' is not a column of the dataset")
+
+    # Hash each distinct key once, zip_code and state are categoricals with few values per row
+    values = frame[key].astype("category")
+    category_shards = np.array([get_shard(value, num_shards) for value in values.cat.categories] + [0]) # Missing keys, code -1, go to shard 0
+    row_shards = category_shards[values.cat.codes.to_numpy()]
+    return [frame[row_shards == shard] for shard in range(num_shards)]
+
+def get_channel_suffix(shard):
+    """Return the suffix appended to the data and request channels of a shard."""
+    return "" if shard is None else f":{shard}"
+
+def get_channel_shard(channel):
+    """Return the shard of a data or request channel, or None if it is not sharded."""
+    parts = channel.split(":")
+    return int(parts[4]) if len(parts) > 4 else None
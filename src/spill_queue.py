@@ -0,0 +1,185 @@
+import json
+import mmap
+import os
+import queue
+import shutil
+import struct
+import threading
+from collections import deque
+from time import sleep
+
+RECORD_HEADER = struct.Struct("<I") # Length of each record in the segment file
+COMPACT_BYTES = 64 * 1024 * 1024 # Consumed bytes after which the segment file is rewritten
+REPLAY_RATE = float(os.environ.get("SPILL_REPLAY_RATE", 10)) # Items replayed per second once a dependency is back
+
+
+class SpillQueue:
+    """
+    FIFO queue for data buffered during an outage.
+
+    Up to max_memory items are held in memory, further items are appended to a
+    segment file and read back through mmap, so memory stays bounded however
+    long the outage lasts. The read offset is stored next to the segment so
+    unsent items are replayed after a restart, and close() moves the items
+    still in memory to disk. Items must be JSON serializable.
+    """
+
+    def __init__(self, path, max_memory=1000, compact_bytes=COMPACT_BYTES):
+        self.path = path
+        self.offset_path = path + ".offset"
+        self.max_memory = max_memory
+        self.compact_bytes = compact_bytes
+        self.lock = threading.Lock()
+        self.memory = deque()
+        self.map = None
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.segment = open(path, "ab")
+        self.size = self.segment.tell()
+        self.offset = self.read_offset()
+        self.disk_items = self.count_records()
+
+    def read_offset(self):
+        try:
+            with open(self.offset_path) as f:
+                return min(int(f.read() or 0), self.size)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def write_offset(self):
+        with open(self.offset_path, "w") as f:
+            f.write(str(self.offset))
+
+    def count_records(self):
+        """Count the unread records in the segment file, dropping a partially written last record."""
+        count = 0
+        position = self.offset
+        with open(self.path, "rb") as f:
+            while position + RECORD_HEADER.size <= self.size:
+                f.seek(position)
+                length, = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+                if position + RECORD_HEADER.size + length > self.size:
+                    break
+                position += RECORD_HEADER.size + length
+                count += 1
+        if position < self.size: # Interrupted append, discard it
+            self.segment.truncate(position)
+            self.size = position
+        return count
+
+    def put(self, item):
+        """Add an item, spilling to disk once the memory bound is reached."""
+        with self.lock:
+            # Items already on disk are older, new items must follow them to keep the order
+            if self.disk_items or len(self.memory) >= self.max_memory:
+                self.append(item)
+            else:
+                self.memory.append(item)
+
+    def append(self, item):
+        data = json.dumps(item).encode()
+        self.segment.write(RECORD_HEADER.pack(len(data)) + data)
+        self.segment.flush()
+        self.size += RECORD_HEADER.size + len(data)
+        self.disk_items += 1
+
+    def read_record(self):
+        """Return the record at the read offset and its size on disk."""
+        if self.map is None or len(self.map) < self.size:
+            if self.map is not None:
+                self.map.close()
+            with open(self.path, "rb") as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        length, = RECORD_HEADER.unpack_from(self.map, self.offset)
+        start = self.offset + RECORD_HEADER.size
+        return json.loads(self.map[start:start + length]), RECORD_HEADER.size + length
+
+    def peek(self):
+        """Return the oldest item without removing it, raising queue.Empty if there is none."""
+        with self.lock:
+            if self.memory:
+                return self.memory[0]
+            if self.disk_items:
+                return self.read_record()[0]
+            raise queue.Empty
+
+    def get(self):
+        """Remove and return the oldest item, raising queue.Empty if there is none."""
+        with self.lock:
+            if self.memory:
+                return self.memory.popleft()
+            if not self.disk_items:
+                raise queue.Empty
+
+            item, record_size = self.read_record()
+            self.offset += record_size
+            self.disk_items -= 1
+            if not self.disk_items or self.offset >= self.compact_bytes:
+                self.compact()
+            else:
+                self.write_offset()
+            return item
+
+    def compact(self, items=()):
+        """Rewrite the segment file with the given items followed by the unread records."""
+        temp_path = self.path + ".compact"
+        with open(temp_path, "wb") as f:
+            for item in items:
+                data = json.dumps(item).encode()
+                f.write(RECORD_HEADER.pack(len(data)) + data)
+            if self.disk_items:
+                # Copied in blocks, the unread records can be the whole backlog of a long outage
+                with open(self.path, "rb") as segment:
+                    segment.seek(self.offset)
+                    shutil.copyfileobj(segment, f)
+
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.segment.close()
+        os.replace(temp_path, self.path)
+
+        self.segment = open(self.path, "ab")
+        self.size = self.segment.tell()
+        self.offset = 0
+        self.disk_items += len(items)
+        self.write_offset()
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def qsize(self):
+        with self.lock:
+            return len(self.memory) + self.disk_items
+
+    def drain(self, send, rate=REPLAY_RATE):
+        """
+        Send queued items in order, at most rate items per second.
+        An item is only removed once send returns, if send raises the item stays
+        at the head of the queue and the exception propagates.
+
+        Returns:
+            int: The number of items sent.
+        """
+        sent = 0
+        while True:
+            try:
+                item = self.peek()
+            except queue.Empty:
+                return sent
+            send(item)
+            self.get()
+            sent += 1
+            if rate:
+                sleep(1 / rate)
+
+    def close(self):
+        """Move the items held in memory to disk so they survive a restart."""
+        with self.lock:
+            if self.memory:
+                self.compact(self.memory)
+                self.memory.clear()
+            if self.map is not None:
+                self.map.close()
+                self.map = None
+            self.segment.close()
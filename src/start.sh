@@ -3,7 +3,7 @@
 # Function to kill each process individually
 cleanup() {
     echo "Exiting. Terminating all background processes..."
-    kill "$INGESTER_PID" "$PROCESSOR_PID" "$STREAMER_PID" "$FLASK_TEST_PID" 2>/dev/null
+    kill "${INGESTER_PIDS[@]}" "$PROCESSOR_PID" "$STREAMER_PID" "$FLASK_TEST_PID" 2>/dev/null
 }
 
 # Set up trap to call cleanup on EXIT or when interrupted (e.g., Ctrl+C)
@@ -13,8 +13,12 @@ trap cleanup EXIT SIGINT
 
 python3 database.py &
 
-python3 ingester.py &
-INGESTER_PID=$!
+# One Ingester per shard when WEATHER_SHARDS is set
+INGESTER_PIDS=()
+for ((shard = 0; shard < ${WEATHER_SHARDS:-1}; shard++)); do
+    INGESTER_SHARD=$shard python3 ingester.py &
+    INGESTER_PIDS+=($!)
+done
 
 python3 processor.py &
 PROCESSOR_PID=$!
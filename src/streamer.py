@@ -1,134 +1,398 @@
 import redis
 import time
-import pandas as pd
 import logging
-import json
 import os
 import threading
-import queue
+from collections import OrderedDict
+from itertools import islice
 from time import sleep
+import wire
+import messaging
+import sharding
+import metrics
+from spill_queue import SpillQueue
+from pacing import TokenBucket
+from hour_spool import HourSpool
 
-# Initialize logging
-logging.basicConfig(filename="logs.csv", level=logging.INFO, format="%(asctime)s, %(message)s")
+# Defaults, overridable through the environment
+DATA_PATH = os.environ.get("STREAMER_DATA", "../data/weather_data.csv")
+BATCH_SIZE = int(os.environ.get("STREAMER_BATCH_SIZE", 500))
+CHUNK_SIZE = int(os.environ.get("STREAMER_CHUNK_SIZE", 100000)) # Rows read at a time when splitting the dataset
+HOUR_INTERVAL = float(os.environ.get("STREAMER_HOUR_INTERVAL", 600)) # Seconds between the start of two hours
+SPEEDUP = float(os.environ.get("STREAMER_SPEEDUP", 1)) # Replay the hours this many times faster
+# "interval" starts an hour every hour_interval, "ack" starts the next hour as soon as the
+# Processor announces the analytics of the previous one, waiting at most hour_interval
+PACING = os.environ.get("STREAMER_PACING", "interval")
+MAX_BATCH_RATE = float(os.environ.get("STREAMER_MAX_BATCH_RATE", 0)) # Batches published per second, 0 for no limit
+WIRE_FORMAT = os.environ.get("WIRE_FORMAT") # Overrides the format negotiated with the Ingester
+BATCH_CACHE_SIZE = 256 # Maximum number of serialized batches kept in memory
+BACKUP_DIR = "backup_data"
+METRICS_PORT = int(os.environ.get("STREAMER_METRICS_PORT", 9101)) # 0 disables the metrics endpoint
 
-# Initialize the Redis instance
-r = redis.Redis(host='127.0.0.1', port=6379, decode_responses=True)
+BATCHES_PUBLISHED = metrics.Counter("weather_batches_published_total", "Batches published by the Streamer, including those queued during an outage")
+BATCHES_REPLAYED = metrics.Counter("weather_batches_replayed_total", "Batches republished at the Ingester's request")
+PENDING_DEPTH = metrics.Gauge("weather_streamer_pending_messages", "Messages queued while Redis is down")
 
-# Load data and add hour column for processing
-df = pd.read_csv("../data/weather_data.csv")
-df['hour'] = pd.to_datetime(df['time']).dt.hour
-batch_size = 500
-backup_dir = "backup_data"
-pending_data = queue.Queue()  
 
+def get_parts(channel) :
+    channel_name, type_message, batch_index, hour = channel.split(":")[:4] # Sharded channels end with the shard
+    return channel_name, type_message, batch_index, hour
 
-def get_data_hour(hour):
-    """Retrieve data for the specified hour."""
-    return df[df['hour'] == hour]
 
-def publish_data(channel, message):
-    """Attempt to publish data to Redis. If Redis is unavailable, queue data."""
-    try:
-        r.publish(channel, message)
-    
-    except redis.ConnectionError:
-        logging.error(f"STREAMER: Redis down, queuing data for {channel}")
-        pending_data.put((channel, message))  # Add to queue if Redis is down
-        sleep(0.1)
-
-# Threaded function to publish data every 30 seconds
-def publish_data_thread():
-    while True:
-        for hour in range(24):
-            logging.info(f"STREAMER: Starting to publish data for hour {hour}")
-            data_hour = get_data_hour(hour)
-            
-            # Publish data in batches
-            for batch_index, batch_offset in enumerate(range(0, len(data_hour), batch_size)):
-                batch = data_hour.iloc[batch_offset:batch_offset + batch_size]
-                batch_json = batch.to_json(orient='records')
-                # Publish data
-                if batch_offset + batch_size >= len(data_hour): # Last batch
-                    publish_data(f"weather_channel:data:LAST:{hour}", batch_json)
-                    logging.info(f"STREAMER: Publishing batch index LAST for hour {hour}")
-                else:
-                    publish_data(f"weather_channel:data:{batch_index}:{hour}", batch_json)
-            # Sleep for 5 minutes before publishing the next hour's data
-            sleep(600)
-
-def pending_thread_handler():
-    while True:
-        send_pending_data()
-        sleep(30)
-
-# Thread for listening to replay requests
-def send_pending_data():
-    """Send pending data to Redis."""
-    
-    if pending_data.empty():
-        logging.info("STREAMER: No pending data to send.")
-        return
-    try:
-        while not pending_data.empty():
-            channel, message = pending_data.get()
-            r.publish(channel, message)
-            logging.info("STREAMER: Sent pending data to Redis.")
+class Streamer:
+    """
+    Publishes the dataset hour by hour in batches and answers the Ingester's replay requests.
+
+    Nothing is read or connected until start(): the dataset is split into per-hour
+    files in the background and the Redis client is created on first use, unless
+    one is passed in. With a data_ring the batches are handed to a co-located
+    Ingester through shared memory, and only published on Redis as well for
+    remote Ingesters when mirror_redis is set.
+
+    With num_shards above 1 the rows of each hour are split by the hash of their
+    shard_key, and each shard is published on its own channels with its own batch
+    numbering and LAST batch, for the Ingester that owns it.
+    """
+
+    def __init__(self, data_path=DATA_PATH, batch_size=BATCH_SIZE, chunk_size=CHUNK_SIZE, hour_interval=HOUR_INTERVAL,
+                 speedup=SPEEDUP, pacing=PACING, max_batch_rate=MAX_BATCH_RATE, wire_format=WIRE_FORMAT,
+                 batch_cache_size=BATCH_CACHE_SIZE, backup_dir=BACKUP_DIR, redis_client=None, data_ring=None,
+                 mirror_redis=False, num_shards=sharding.NUM_SHARDS, shard_key=sharding.SHARD_KEY):
+        self.data_path = data_path
+        self.batch_size = batch_size
+        self.hour_interval = hour_interval
+        self.speedup = speedup
+        self.pacing = pacing
+        self.wire_format = wire_format
+        self.batch_cache_size = batch_cache_size
+        self.backup_dir = backup_dir
+        self.client = redis_client
+        self.data_ring = data_ring
+        self.mirror_redis = mirror_redis
+        self.num_shards = num_shards
+        self.shard_key = shard_key
+
+        self.publish_bucket = TokenBucket(max_batch_rate) # Shared by live, replayed and pending batches to protect InfluxDB
+        # The dataset is split into per-hour files in the background, only the hours being published are held in memory
+        self.spool = HourSpool(data_path, chunk_size=chunk_size)
+        self.pending_data = None # Opened by start()
+        self.batch_cache = OrderedDict() # (hour, batch_index, format) -> serialized batch, least recently used first
+        self.batch_cache_lock = threading.Lock()
+        self.shard_frames = OrderedDict() # hour -> rows of each shard, for the hours in the spool's cache
+        self.shard_frames_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.threads = []
+
+    @property
+    def r(self):
+        if self.client is None:
+            self.client = messaging.get_redis()
+        return self.client
+
+    def start(self):
+        """Open the outage queue and start loading, publishing and answering replay requests."""
+        if self.threads:
+            return self
+        self.stopped.clear()
+        self.pending_data = SpillQueue(os.path.join(self.backup_dir, "streamer_pending.log"))
+        PENDING_DEPTH.set_function(self.pending_data.qsize)
+        targets = [self.load_data_thread, self.publish_data_thread, self.pending_thread_handler]
+        if self.data_ring is None or self.mirror_redis: # Replays are only requested by Ingesters reading Redis
+            targets.append(self.listening_incoming_messages)
+        for target in targets:
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def stop(self, timeout=5):
+        """Stop the threads and move the data queued during an outage to disk."""
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+        if self.pending_data is not None:
+            self.pending_data.close()
+        logging.info("STREAMER: Shutting down.")
+
+    def load_data_thread(self):
+        try:
+            self.spool.build()
+            logging.info(f"STREAMER: Loaded {sum(self.spool.row_counts.values())} rows from {self.data_path}")
+        except Exception as e: # e.g. a missing file or a CSV without a time column
+            logging.error(f"STREAMER: Failed to load {self.data_path}: {e}")
+        finally:
+            self.spool.ready.set() # Publish empty hours rather than block forever
+
+    def get_data_hour(self, hour):
+        """Retrieve data for the specified hour."""
+        return self.spool.get_hour(hour)
+
+    def get_shard_rows(self, hour, shard=None):
+        """Return the rows of the hour published on the shard, all of them when not sharded."""
+        if shard is None:
+            return self.get_data_hour(hour)
+        with self.shard_frames_lock:
+            if hour in self.shard_frames:
+                self.shard_frames.move_to_end(hour)
+                return self.shard_frames[hour][shard]
+
+        frames = sharding.split_frame(self.get_data_hour(hour), self.num_shards, self.shard_key)
+        with self.shard_frames_lock:
+            self.shard_frames[hour] = frames
+            self.shard_frames.move_to_end(hour)
+            while len(self.shard_frames) > self.spool.cached_hours:
+                self.shard_frames.popitem(last=False)
+        return frames[shard]
+
+    def get_num_batches(self, hour, shard=None):
+        """Return the number of batches published for the specified hour and shard."""
+        if shard is None:
+            return -(-self.spool.get_num_rows(hour) // self.batch_size)
+        if not self.spool.get_num_rows(hour):
+            return 0
+        # A shard without rows still publishes an empty LAST batch, so its Ingester completes the hour
+        return max(1, -(-len(self.get_shard_rows(hour, shard)) // self.batch_size))
+
+    def get_wire_format(self):
+        """Return the batch format to publish, as advertised by the Ingester unless overridden."""
+        if self.wire_format:
+            return self.wire_format
+        try:
+            advertised = self.r.get(wire.FORMAT_KEY)
+        except redis.ConnectionError:
+            advertised = None
+        return advertised if advertised in wire.FORMATS else "json"
+
+    def get_batch_payload(self, batch_index, hour, batch_format, shard=None):
+        """Return the serialized batch, using the cache to avoid re-serializing replayed batches."""
+        key = (hour, shard, batch_index, batch_format)
+        with self.batch_cache_lock:
+            if key in self.batch_cache:
+                self.batch_cache.move_to_end(key)
+                return self.batch_cache[key]
+
+        num_batches = self.get_num_batches(hour, shard)
+        if batch_index < 0 or batch_index >= num_batches:
+            start = end = 0
+        else:
+            start = batch_index * self.batch_size
+            end = start + self.batch_size
+        rows = self.get_shard_rows(hour, shard).iloc[start:end]
+        if batch_format == wire.LOCAL_FORMAT:
+            payload = wire.encode_columns(rows, num_batches=num_batches)
+        else:
+            payload = wire.encode_batch(rows, batch_format, num_batches=num_batches)
+
+        with self.batch_cache_lock:
+            self.batch_cache[key] = payload
+            self.batch_cache.move_to_end(key)
+            while len(self.batch_cache) > self.batch_cache_size:
+                self.batch_cache.popitem(last=False) # Evict the least recently used batch
+        return payload
+
+    def publish_data(self, channel, message):
+        """Attempt to publish data to Redis. If Redis is unavailable, queue data and return False."""
+        self.publish_bucket.acquire()
+        try:
+            messaging.publish(self.r, channel, message)
+            return True
+
+        except redis.ConnectionError:
+            logging.error(f"STREAMER: Redis down, queuing data for {channel}")
+            self.pending_data.put((channel, message))  # Add to queue if Redis is down, spills to disk past the memory bound
             sleep(0.1)
+            return False
 
-    except redis.ConnectionError:
-        logging.error(f"STREAMER: Redis still down, requeuing data for {channel}")
-        pending_data.put((channel, message))  # Add to queue if Redis is down
-        sleep(15) # timeout 
-            
+    def publish_burst(self, messages, counter=BATCHES_PUBLISHED):
+        """
+        Publish (channel, message) pairs in pipelined round trips paced by the publish bucket, counted by counter.
+        Messages of a round trip that failed because Redis is down are queued.
+        """
+        messages = iter(messages)
+        while True:
+            chunk = list(islice(messages, messaging.PIPELINE_SIZE))
+            if not chunk:
+                return
+            self.publish_bucket.acquire(len(chunk))
+            try:
+                messaging.publish_many(self.r, chunk)
+                counter.inc(len(chunk))
+            except redis.ConnectionError:
+                logging.error(f"STREAMER: Redis down, queuing {len(chunk)} batches")
+                for message in chunk:
+                    self.pending_data.put(message)
+                sleep(0.1)
 
-def get_parts(channel) :
-    channel_name, type_message, batch_index, hour = channel.split(":")
-    return channel_name, type_message, batch_index, hour
+    def get_hour_messages(self, hour, batch_format):
+        """
+        Yield the (channel, payload) of every batch of the hour, the last one of each shard on its LAST channel.
+        Shards are interleaved so their Ingesters work in parallel.
+        """
+        num_batches = {shard: self.get_num_batches(hour, shard) for shard in sharding.get_shards(self.num_shards)}
+        for batch_index in range(max(num_batches.values())):
+            for shard, count in num_batches.items():
+                if batch_index >= count:
+                    continue
+                payload = self.get_batch_payload(batch_index, hour, batch_format, shard)
+                suffix = sharding.get_channel_suffix(shard)
+                if batch_index == count - 1: # Last batch
+                    yield f"weather_channel:data:LAST:{hour}{suffix}", payload
+                else:
+                    yield f"weather_channel:data:{batch_index}:{hour}{suffix}", payload
+
+    def subscribe_analytics(self, hour):
+        """Subscribe to the Processor's announcement for the hour, or return None if pacing does not wait for it."""
+        if self.pacing != "ack":
+            return None
+        try:
+            return messaging.subscribe(self.r, [f"weather_channel:analytics:{hour:02d}"],
+                                       self.r.pubsub(ignore_subscribe_messages=True))
+        except redis.ConnectionError:
+            return None
+
+    def wait_for_next_hour(self, started, pubsub):
+        """Wait until the next hour is due, or until the Processor announces the hour's analytics when pacing on acks."""
+        deadline = started + self.hour_interval / self.speedup
+        if pubsub is not None:
+            try:
+                while time.monotonic() < deadline and not self.stopped.is_set():
+                    if pubsub.get_message(timeout=min(1.0, deadline - time.monotonic())):
+                        return
+            except redis.ConnectionError:
+                pass
+            finally:
+                pubsub.close()
+        self.stopped.wait(max(0, deadline - time.monotonic()))
+
+    # Threaded function to publish one hour of data per interval
+    def publish_data_thread(self):
+        while not self.stopped.is_set():
+            for hour in range(24):
+                if self.stopped.is_set():
+                    return
+                logging.info(f"STREAMER: Starting to publish data for hour {hour}")
+                started = time.monotonic()
+                self.record_hour_started(hour)
+                pubsub = self.subscribe_analytics(hour) # Subscribed before publishing so the announcement is not missed
+
+                try:
+                    if self.data_ring is not None:
+                        # Waits while the ring is full, so the co-located Ingester never misses a batch
+                        for message in self.get_hour_messages(hour, wire.LOCAL_FORMAT):
+                            self.publish_bucket.acquire()
+                            self.data_ring.put(message)
+                            BATCHES_PUBLISHED.inc()
+                    if self.data_ring is None or self.mirror_redis:
+                        # Publish data in batches, several per round trip
+                        self.publish_burst(self.get_hour_messages(hour, self.get_wire_format()))
+                    if self.spool.get_num_rows(hour):
+                        logging.info(f"STREAMER: Publishing batch index LAST for hour {hour}")
+                except Exception as e: # e.g. the hour's file was removed from the spool, the next hours are still published
+                    logging.error(f"STREAMER: Failed to publish hour {hour}: {e}")
+                self.wait_for_next_hour(started, pubsub)
+
+    def record_hour_started(self, hour):
+        """Store when the hour started being published, for the Processor's end to end latency."""
+        try:
+            self.r.set(f"weather_metrics:hour_started:{hour}", time.time(), ex=86400)
+        except redis.ConnectionError:
+            pass
+
+    def pending_thread_handler(self):
+        while not self.stopped.is_set():
+            self.send_pending_data()
+            self.stopped.wait(30)
+
+    def send_pending_message(self, item):
+        self.publish_bucket.acquire()
+        messaging.publish(self.r, item[0], item[1])
+        BATCHES_PUBLISHED.inc()
+
+    def send_pending_data(self):
+        """Send pending data to Redis."""
+
+        if self.pending_data.empty():
+            logging.info("STREAMER: No pending data to send.")
+            return
+        try:
+            # Replayed in order and paced by the publish bucket, a message is only removed once published
+            sent = self.pending_data.drain(self.send_pending_message, rate=0)
+            logging.info(f"STREAMER: Sent {sent} pending messages to Redis.")
 
-def get_data_hour_batch(batch_index, hour):
-    data_hour = get_data_hour(int(hour))
-    batch_offset = int(batch_index) * batch_size
-    batch = data_hour.iloc[batch_offset:batch_offset + batch_size]
-    return batch.to_json(orient='records')
-
-def listening_incoming_messages():
-    """Listen for replay requests from ingester and republish data if requested."""
-    
-    while True:
-        try: 
-            pubsub = r.pubsub()
-            pubsub.psubscribe("weather_channel:request:*")
-
-            for message in pubsub.listen():
-
-                if message["type"] == "pmessage":
-                    channel = message["channel"]
-                    channel_name, type_message, batch_index, hour = get_parts(channel)
-                
-                    if channel.startswith("weather_channel:request:"):
-                        logging.info(f"STREAMER: Received request for data:{batch_index}:{hour}")
-                        batch_data = get_data_hour_batch(batch_index, hour)
-                        publish_data(f"weather_channel:data:{batch_index}:{hour}", batch_data)
         except redis.ConnectionError:
-            sleep(15)
-                
-
-# Start the data publishing thread
-publish_thread = threading.Thread(target=publish_data_thread, daemon=True)
-publish_thread.start()
-
-# Start listening for replay requests in a separate thread
-pending_data_thread = threading.Thread(target=pending_thread_handler, daemon=True)
-pending_data_thread.start()
-
-# Start listening for replay requests in a separate thread
-listening_thread = threading.Thread(target=listening_incoming_messages, daemon=True)
-listening_thread.start()
-
-# Keep the main thread alive to maintain the background threads
-try:
-    while True:
-        sleep(1)
-except KeyboardInterrupt:
-    logging.info("STREAMER: Shutting down.")
-    print("Shutting down...")
+            logging.error(f"STREAMER: Redis still down, keeping {self.pending_data.qsize()} pending messages")
+            self.stopped.wait(15) # timeout
+
+    def get_data_hour_batch(self, batch_index, hour, shard=None):
+        return self.get_batch_payload(int(batch_index), int(hour), self.get_wire_format(), shard)
+
+    def replay_batches(self, indexes, hour, shard=None):
+        """
+        Republish the requested batches of an hour's shard in one pipelined burst. The last batch goes on
+        its LAST channel again and indexes past it are skipped, they were requested by an Ingester that
+        lost the LAST batch and did not know how many batches the hour has.
+        """
+        batch_format = self.get_wire_format()
+        suffix = sharding.get_channel_suffix(shard)
+        num_batches = self.get_num_batches(int(hour), shard)
+        messages = ((f"weather_channel:data:{'LAST' if batch_index == num_batches - 1 else batch_index}:{hour}{suffix}",
+                     self.get_batch_payload(batch_index, int(hour), batch_format, shard))
+                    for batch_index in indexes if 0 <= batch_index < num_batches)
+        self.publish_burst(messages, BATCHES_REPLAYED)
+
+    def handle_request(self, message):
+        """Republish the batches asked for by a replay request."""
+        channel = message["channel"]
+        channel_name, type_message, batch_index, hour = get_parts(channel)
+        shard = sharding.get_channel_shard(channel)
+        suffix = sharding.get_channel_suffix(shard)
+
+        if batch_index == "BATCHES": # Index ranges of every missing batch of the hour
+            indexes = wire.parse_ranges(message["data"])
+            logging.info(f"STREAMER: Received request for {len(indexes)} batches {message['data']} of hour {hour}{suffix}")
+            self.replay_batches(indexes, hour, shard)
+        elif batch_index == "LAST":
+            logging.info(f"STREAMER: Received request for data:LAST:{hour}{suffix}")
+            self.replay_batches([self.get_num_batches(int(hour), shard) - 1], hour, shard)
+        elif channel.startswith("weather_channel:request:"):
+            logging.info(f"STREAMER: Received request for data:{batch_index}:{hour}{suffix}")
+            batch_data = self.get_data_hour_batch(batch_index, hour, shard)
+            if self.publish_data(f"weather_channel:data:{batch_index}:{hour}{suffix}", batch_data):
+                BATCHES_REPLAYED.inc()
+
+    def listening_incoming_messages(self):
+        """Listen for replay requests from ingester and republish data if requested."""
+
+        pubsub = None
+        while not self.stopped.is_set():
+            try:
+                pubsub = messaging.subscribe(self.r, ["weather_channel:request:*"], pubsub)
+
+                while not self.stopped.is_set():
+                    message = pubsub.get_message(timeout=1.0)
+
+                    if message is not None and message["type"] == "pmessage":
+                        try:
+                            self.handle_request(message)
+                        except (ValueError, IndexError, OSError) as e: # Malformed channel, range list or shard, or an unreadable hour file
+                            logging.error(f"STREAMER: Ignoring invalid request on {message['channel']}: {e}")
+            except redis.ConnectionError:
+                self.stopped.wait(15)
+        if pubsub is not None:
+            pubsub.close()
+
+if __name__ == "__main__":
+    # Initialize logging
+    logging.basicConfig(filename="logs.csv", level=logging.INFO, format="%(asctime)s, %(message)s")
+
+    streamer = Streamer().start()
+    metrics.serve(METRICS_PORT)
+
+    # Keep the main thread alive to maintain the background threads
+    try:
+        while True:
+            sleep(1)
+    except KeyboardInterrupt:
+        streamer.stop()
+        print("Shutting down...")
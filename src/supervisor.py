@@ -0,0 +1,113 @@
+"""
+Runs the Streamer, Ingester, Processor and API on one host as cooperating processes.
+
+Batches go from the Streamer to the Ingester, and completed hours from the
+Ingester to the Processor, through shared memory rings instead of the Redis
+channels, so co-located components need no Redis. With --mirror-redis they are
+also published on weather_channel:data:* and weather_channel:processor:* for
+remote consumers. A component that exits is restarted and resumes reading its
+ring where it stopped.
+
+    python3 supervisor.py [--no-api] [--mirror-redis] [--ring-mb 64]
+"""
+import argparse
+import logging
+import multiprocessing
+import signal
+from time import sleep
+from ring_buffer import RingBuffer
+import metrics
+
+COMPONENTS = ["ingester", "processor", "streamer", "api"]
+
+
+stopping = False
+
+
+def request_stop(signum, frame):
+    # Only sets a flag, setting the shared stop event from a signal handler could deadlock on its lock
+    global stopping
+    stopping = True
+
+
+def run_component(name, data_ring, notify_ring, mirror_redis, stop_event):
+    """Entry point of each child process, runs one component until the supervisor stops it."""
+    # Ctrl+C and kill reach the whole process group, the components wait for the stop event
+    # instead so they can flush what they hold
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    logging.basicConfig(filename="logs.csv", level=logging.INFO, format="%(asctime)s, %(message)s")
+
+    if name == "api":
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        import flask_test
+        flask_test.run_server(use_reloader=False) # Runs until the supervisor terminates it
+        return
+    if name == "streamer":
+        import streamer as module
+        # One Ingester reads the whole ring, so the hours are not split into shards
+        component = module.Streamer(data_ring=data_ring, mirror_redis=mirror_redis, num_shards=1)
+    elif name == "ingester":
+        import ingester as module
+        component = module.Ingester(data_ring=data_ring, notify_ring=notify_ring, mirror_redis=mirror_redis, num_shards=1)
+    else:
+        import processor as module
+        component = module.Processor(notify_ring=notify_ring)
+
+    component.start()
+    metrics.serve(module.METRICS_PORT) # The API serves /metrics itself
+    stop_event.wait()
+    component.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--no-api", action="store_true", help="Do not start the API")
+    parser.add_argument("--mirror-redis", action="store_true", help="Also publish batches and notifications on Redis")
+    parser.add_argument("--ring-mb", type=int, default=64, help="Size of the batch ring in MB")
+    args = parser.parse_args()
+
+    logging.basicConfig(filename="logs.csv", level=logging.INFO, format="%(asctime)s, %(message)s")
+    # Children inherit the rings, fork keeps them attached to the same shared memory
+    context = multiprocessing.get_context("fork")
+    data_ring = RingBuffer(args.ring_mb * 1024 * 1024)
+    notify_ring = RingBuffer(1024 * 1024)
+    stop_event = context.Event()
+    names = [name for name in COMPONENTS if not (name == "api" and args.no_api)]
+    processes = {}
+
+    def launch(name):
+        process = context.Process(target=run_component, name=name,
+                                  args=(name, data_ring, notify_ring, args.mirror_redis, stop_event))
+        process.start()
+        processes[name] = process
+        logging.info(f"SUPERVISOR: Started {name} as process {process.pid}")
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+    try:
+        for name in names:
+            launch(name)
+        while not stopping:
+            for name, process in list(processes.items()):
+                if not process.is_alive():
+                    logging.error(f"SUPERVISOR: {name} exited with code {process.exitcode}, restarting")
+                    launch(name)
+            sleep(1)
+    finally:
+        stop_event.set()
+        for process in processes.values():
+            if process.name == "api":
+                process.terminate()
+            process.join(15)
+            if process.is_alive():
+                process.kill()
+        for ring in (data_ring, notify_ring):
+            ring.close()
+            ring.unlink()
+        logging.info("SUPERVISOR: Shutting down.")
+        print("Shutting down...")
+
+
+if __name__ == "__main__":
+    main()
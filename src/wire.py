@@ -0,0 +1,156 @@
+import base64
+import json
+import zlib
+import numpy as np
+import pandas as pd
+
+# Current version of the columnar batch format
+WIRE_VERSION = 2
+
+# Redis key the Ingester uses to advertise the formats it can decode
+FORMAT_KEY = "weather_config:wire_format"
+
+# Supported formats, "json" is the original list of records
+FORMATS = ["json", "columnar", "columnar+zlib"]
+
+# Decoded columns handed to a co-located consumer in memory, see encode_columns
+LOCAL_FORMAT = "local"
+
+# Columns the Ingester writes to InfluxDB, the Streamer only ships these
+WIRE_COLUMNS = ['time', 'zip_code', 'state', 'temp_c', 'pressure_mb', 'humidity', 'precip_mm']
+
+
+class WireFormatError(ValueError):
+    """Raised when a batch payload cannot be decoded."""
+
+
+def get_header(compressed, num_batches=None):
+    """Return the version header prefixed to every columnar payload."""
+    header = f"WV{WIRE_VERSION}{'z' if compressed else ''}"
+    if num_batches is not None:
+        header += f"/{num_batches}"
+    return header + "|"
+
+def parse_header(payload):
+    """
+    Parse the header of a payload without decoding its body.
+
+    Returns:
+        tuple: (version, compressed, num_batches, body), version is None for the original JSON records.
+    """
+    if payload.startswith("["):
+        return None, False, None, payload
+
+    header, separator, body = payload.partition("|")
+    if not separator or not header.startswith("WV"):
+        raise WireFormatError("Missing batch header")
+
+    header, _, num_batches = header[2:].partition("/")
+    compressed = header.endswith("z")
+    try:
+        return int(header.rstrip("z")), compressed, int(num_batches) if num_batches else None, body
+    except ValueError:
+        raise WireFormatError(f"Invalid batch header '{header}'")
+
+def get_num_batches(payload):
+    """Return the number of batches in the hour announced by the payload header, if any."""
+    if isinstance(payload, dict): # Decoded batch handed over in memory
+        return payload.get("num_batches")
+    return parse_header(payload)[2]
+
+def get_column_values(values):
+    """Return a column as a list, with missing values as None so they are encoded as null rather than NaN."""
+    if values.isna().any():
+        values = values.astype(object).where(values.notna(), None)
+    return values.tolist()
+
+def encode_columns(batch, columns=WIRE_COLUMNS, num_batches=None):
+    """
+    Return a batch as the decoded columnar dictionary holding one numpy array per column, for consumers
+    that receive it in memory. Numeric columns keep their binary layout instead of becoming lists of values.
+    """
+    columns = [column for column in columns if column in batch.columns]
+    data = [np.ascontiguousarray(batch[column].to_numpy()) for column in columns]
+    return {"columns": columns, "data": data, "num_batches": num_batches}
+
+def encode_batch(batch, wire_format="columnar", columns=WIRE_COLUMNS, num_batches=None):
+    """
+    Serialize a DataFrame batch for publishing.
+
+    Parameters:
+        batch (DataFrame): The rows to publish.
+        wire_format (str): One of FORMATS.
+        columns (list): Columns to ship, missing columns are skipped.
+        num_batches (int): Number of batches in the hour, announced in the header.
+
+    Returns:
+        str: The payload, a header followed by the column arrays for columnar formats.
+    """
+    if wire_format == "json":
+        return batch.to_json(orient='records')
+
+    if wire_format not in FORMATS:
+        raise WireFormatError(f"Unknown wire format '{wire_format}'")
+
+    columns = [column for column in columns if column in batch.columns]
+    # NaN is not valid JSON and would reach InfluxDB as an invalid field value
+    body = json.dumps({"columns": columns, "data": [get_column_values(batch[column]) for column in columns]}, allow_nan=False)
+
+    if wire_format == "columnar+zlib":
+        body = base64.b64encode(zlib.compress(body.encode())).decode()
+        return get_header(True, num_batches) + body
+    return get_header(False, num_batches) + body
+
+def decode_batch(payload):
+    """
+    Decode a payload produced by encode_batch.
+
+    Returns:
+        dict: {"columns": [...], "data": [[values of column 0], [values of column 1], ...]}
+    """
+    if isinstance(payload, dict): # Already decoded, see encode_columns
+        return payload
+
+    version, compressed, num_batches, body = parse_header(payload)
+
+    if version is None: # Original list of records
+        records = json.loads(payload)
+        columns = list(records[0].keys()) if records else []
+        return {"columns": columns, "data": [[record.get(column) for record in records] for column in columns]}
+
+    if version != WIRE_VERSION:
+        raise WireFormatError(f"Unsupported batch version '{version}'")
+
+    try:
+        if compressed:
+            body = zlib.decompress(base64.b64decode(body)).decode()
+        return json.loads(body)
+    except (zlib.error, ValueError) as e:
+        raise WireFormatError(f"Invalid batch payload: {e}")
+
+def format_ranges(indexes):
+    """Compact sorted batch indexes into a range list, e.g. [0, 1, 2, 5] -> "0-2,5"."""
+    ranges = []
+    for index in indexes:
+        if ranges and ranges[-1][1] == index - 1:
+            ranges[-1][1] = index
+        else:
+            ranges.append([index, index])
+    return ",".join(str(start) if start == end else f"{start}-{end}" for start, end in ranges)
+
+def parse_ranges(text):
+    """Expand a range list produced by format_ranges into batch indexes."""
+    indexes = []
+    for part in filter(None, text.split(",")):
+        start, _, end = part.partition("-")
+        indexes.extend(range(int(start), int(end or start) + 1))
+    return indexes
+
+def iter_records(batch):
+    """Yield each row of a decoded batch as a dictionary."""
+    columns = batch["columns"]
+    # Arrays handed over in memory become Python values, with None for missing values, like decoded JSON
+    data = [get_column_values(pd.Series(values, copy=False)) if isinstance(values, np.ndarray) else values
+            for values in batch["data"]]
+    for values in zip(*data):
+        yield dict(zip(columns, values))